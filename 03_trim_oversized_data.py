@@ -1,12 +1,13 @@
-import pandas as pd
-import numpy as np
-import os
+from trace_store import set_view
 
 ### Most time series phase contrast intensity time series were 10000 time points long. Running the Fiji intensity profile function took excessive amounts of time for more time points.
 ### It was easiest to load in stacks of data starting at a multiple of 10000, e.g. loading the time points 10000 to 19999 using the regular expression '(xy000_PC_T1.....png)' in
 ### the filter box while using the Fiji 'Import image sequence' function. However, when the lysis event crossed over a multiple of 10000, a longer image sequence was used to capture the important features.
 ### This script trims the oversized data down to the standard size of 10000 time points, so that there is less irrelevant data which could potentially produce errors in the code if not removed.
+### The trim is a view (see trace_store.set_view): the stored data is not rewritten, so running the script again, or changing a range, is safe,
+### and the full trace can still be read with load_trace(cell, full=True). The detection and plotting steps themselves work on traces of any length.
 ### The table '10ms_lysis_fiji_data_summary.csv' summarises the original time point ranges. The reason for the trim chosen in each case can be inferred from the time series plots (02_plot_time_series.py).
+### New acquisitions can be extracted from the image sequences directly with extraction.py, which has no limit on the number of time points.
 
 # {cell: new_timepoint_range}
 trim = {24: [50, 150],
@@ -18,9 +19,6 @@ trim = {24: [50, 150],
         47: [650, 750],
         48: [650, 750]}
 
-# trim and update the table
+# record the trimmed time range of each cell
 for k, v in trim.items():
-    d = pd.read_csv("lysis_data_time_adjusted/lysis_{}.csv".format(str(k).zfill(2)))
-    d = d[(d["time"] >= v[0]) & (d["time"] < v[1])]
-    d.to_csv("lysis_data_time_adjusted/lysis_{}.csv".format(str(k).zfill(2)))
-    
+    set_view(k, v[0], v[1])
@@ -4,6 +4,9 @@ import os
 import matplotlib.pyplot as plt
 from scipy.signal import savgol_filter
 from scipy.signal import find_peaks
+from crossing import find_crossing_point
+from trace_store import load_trace
+from trace_index import time_window
 
 ### This script details the algorithm development for lysis detection (the breakdown of the cell envelope). Variables referring to fast_lysis are referring to this process.
 ### The detection algorithm will be based on finding the time point at which the time derivative of phase contrast intensity rapidly accelerates; in practice this will be
@@ -14,9 +17,9 @@ from scipy.signal import find_peaks
 lysis_times_adjusted = pd.read_csv("10ms_lysis_times_adjusted.csv")
 
 test_cell = 6
-d = pd.read_csv("lysis_data_time_adjusted/lysis_{}.csv".format(str(test_cell).zfill(2))) # time series intensity data
+d = load_trace(test_cell) # time series intensity data
 lys_t = lysis_times_adjusted["lysis_t"][lysis_times_adjusted["cell"] == test_cell].tolist()[0]
-d = d[(d["time"] >= lys_t - 2) & (d["time"] < lys_t + 2)]  # observe a period 2 seconds before and after the estimated lysis time.
+d = pd.DataFrame(time_window(d, lys_t - 2, lys_t + 2))  # observe a period 2 seconds before and after the estimated lysis time.
 
 # compare two filtering algorithms, moving average and Savitzky-Golay
 # moving average implementation
@@ -87,42 +90,6 @@ plt.close()
 
 ### Now we need to find the point at which the derivative crosses the threshold (mean + 3 standard deviations)
 
-# define a function that can find when time series crosses a defined threshold
-def find_crossing_point(time_arr, value_arr, threshold_value, window_length, start_idx=0, mode="increasing"):
-    """
-    A general function for finding when a time series (value_arr) crosses threshold_value for a minimum of
-    window_length number of time points. The starting index is specified by start_idx if error causing or
-    irrelevant data in the array needs to be skipped over. The mode can be set to "increasing" (default) if
-    you wish to find when an array increases above a threshold, or set to a different value (e.g "decreasing")
-    if you wish to find when it decreases below a threshold. 
-    
-    return: crossing_idx, the first index at which the array crosses the threshold for a minimum of window_length 
-    consecutive time points. Also returns the corresponding time.
-    If the function reaches the end of the array without meeting the threshold crossing conditions, return None.
-    """
-    threshold_counter = 0
-    idx = start_idx - 1
-    while (idx < len(value_arr)) and (threshold_counter < window_length):
-        idx = idx + 1
-        value = value_arr[idx]
-        t = time_arr[idx]
-        if mode == "increasing":
-            if value > threshold_value:
-                threshold_counter = threshold_counter + 1
-            else:
-                threshold_counter = 0
-        else:
-            if value < threshold_value:
-                threshold_counter = threshold_counter + 1
-            else:
-                threshold_counter = 0
-    
-    if idx < len(value_arr):
-        crossing_idx = idx - (window_length - 1)
-        return crossing_idx, time_arr[crossing_idx]
-    else:
-        return None
-
 # find when the lysis starts, i.e when the derivative rises above the threshold of 3 standard deviations above the mean derivative during perforation
 # this is the time reported as t5 in the paper.
 value_arr = np.asarray(d["dsg"])
@@ -0,0 +1,150 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from cache import CACHE_DIR
+from chunked import chunked_savgol_derivative
+from collate import collate_cells
+from lysis_detection import stack_lysis_windows, detect_lysis_batch
+from perforation_detection import baseline_start_index, detect_perforation
+from plotting import render_all
+from synthetic import generate_experiment
+from trace_store import STORE_DIR, load_trace
+from trace_index import nearest_index
+
+### A benchmark of the analysis stages on synthetic experiments (see synthetic.py) of increasing trace length, for tracking
+### throughput and correctness together on any machine. For every size, an experiment is generated in a temporary directory and
+### each stage is timed: collation of the Fiji region files (01, for sizes up to max_collate_frames, as the text files get large),
+### Savitzky-Golay filtering of the full traces, lysis detection (06), a rerun of the lysis detection on the same windows without and
+### with a warm derivative cache (as when iterating over thresholds, see cache.py), perforation detection (08) and plotting (02).
+### The lysis and perforation start times found are compared with the ground truth of the generator, and a size fails if any cell
+### is further off than t5_tolerance or t4_tolerance time points, or if the cached rerun differs from the uncached one.
+
+STAGES = ["collation", "filtering", "lysis_detection", "lysis_rerun", "lysis_rerun_cached", "perforation_detection", "plotting"]
+SIZES = [10000, 100000, 1000000, 10000000]
+
+def _timed(results, frames, n_cells, stage, func):
+    t0 = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - t0
+    results.append({"frames": frames, "cells": n_cells, "stage": stage, "seconds": seconds, "frames_per_second": frames * n_cells / seconds})
+    return value
+
+def benchmark_size(n_frames, n_cells=4, stages=STAGES, work_dir=None, max_collate_frames=1000000, baseline_offset=1000,
+                   t4_tolerance=10, t5_tolerance=5, seed=0):
+    """
+    Generates a synthetic experiment of n_cells traces of n_frames time points in work_dir (a temporary directory if None) and
+    runs the requested stages on it.
+
+    return: a table of timings (frames, cells, stage, seconds, frames_per_second) and a table of detection errors per cell (cell,
+    t4_error and t5_error, in time points, NaN where not detected or the stage was not run).
+    """
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="lysis_benchmark_")
+    try:
+        write_regions = "collation" in stages and n_frames <= max_collate_frames
+        truth, cells, spacings = generate_experiment(work_dir, n_cells, n_frames, seed=seed, write_regions=write_regions)
+        store_dir = os.path.join(work_dir, STORE_DIR)
+        fs = spacings[0]
+        results = []
+        errors = truth[["cell"]].copy()
+        errors["t4_error"] = np.nan
+        errors["t5_error"] = np.nan
+
+        if write_regions:
+            _timed(results, n_frames, n_cells, "collation",
+                   lambda: collate_cells(cells, spacings, input_dir=work_dir, store_dir=os.path.join(work_dir, "collated")))
+        if "filtering" in stages:
+            _timed(results, n_frames, n_cells, "filtering",
+                   lambda: [chunked_savgol_derivative(load_trace(k, columns=["c"], store_dir=store_dir)["c"]) for k in cells])
+
+        fast_lysis = None
+        lysis_stages = ["lysis_detection", "lysis_rerun", "lysis_rerun_cached", "perforation_detection"]
+        if any(stage in stages for stage in lysis_stages):
+            def detect_lysis():
+                lysis_times = pd.read_csv(os.path.join(work_dir, "10ms_lysis_times_adjusted.csv"))
+                traces = {k: load_trace(k, columns=["time", "c"], store_dir=store_dir) for k in cells}
+                lys_ts = dict(zip(lysis_times["cell"], lysis_times["lysis_t"]))
+                windows = stack_lysis_windows(traces, lys_ts, half_width=2)
+                return windows, detect_lysis_batch(*windows[1:])
+            (cell_ids, time_arr, value_arr, lengths), fast_lysis = _timed(results, n_frames, n_cells, "lysis_detection", detect_lysis)
+            errors["t5_error"] = (np.asarray(fast_lysis["rise_time"]) - truth["t5"].to_numpy()) / fs
+
+        if "lysis_rerun" in stages:
+            _timed(results, n_frames, n_cells, "lysis_rerun", lambda: detect_lysis_batch(time_arr, value_arr, lengths))
+        errors["cache_ok"] = True
+        if "lysis_rerun_cached" in stages:
+            cache_dir = os.path.join(work_dir, CACHE_DIR)
+            detect_lysis_batch(time_arr, value_arr, lengths, cache_dir=cache_dir) # fill the cache
+            cached = _timed(results, n_frames, n_cells, "lysis_rerun_cached",
+                            lambda: detect_lysis_batch(time_arr, value_arr, lengths, cache_dir=cache_dir))
+            errors["cache_ok"] = np.isclose(cached["rise_time"], fast_lysis["rise_time"], rtol=0, atol=0, equal_nan=True)
+
+        if "perforation_detection" in stages:
+            def detect_perforations():
+                start_times = []
+                for i, k in enumerate(cell_ids):
+                    d = load_trace(k, columns=["timepoint", "time", "c"], store_dir=store_dir)
+                    start_idx = baseline_start_index(d["timepoint"], nearest_index(d["time"], fast_lysis["peak_time"][i]), baseline_offset)
+                    start_times.append(detect_perforation(d["time"], d["c"], start_idx)[1])
+                return np.asarray(start_times)
+            start_times = _timed(results, n_frames, n_cells, "perforation_detection", detect_perforations)
+            errors["t4_error"] = (start_times - truth["t4"].to_numpy()) / fs
+
+        if "plotting" in stages:
+            _timed(results, n_frames, n_cells, "plotting",
+                   lambda: render_all(cells, force=True, plot_dir=os.path.join(work_dir, "plots"), store_dir=store_dir, dpi=100))
+
+        errors["t4_ok"] = ~(np.abs(errors["t4_error"]) > t4_tolerance) # NaN (not run) counts as ok, but not a failed detection
+        errors["t5_ok"] = ~(np.abs(errors["t5_error"]) > t5_tolerance)
+        if "perforation_detection" in stages:
+            errors["t4_ok"] &= errors["t4_error"].notna()
+        if any(stage in stages for stage in lysis_stages):
+            errors["t5_ok"] &= errors["t5_error"].notna()
+        return pd.DataFrame(results), errors
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_benchmark(sizes=SIZES, n_cells=4, stages=STAGES, **kwargs):
+    """
+    Runs benchmark_size for every size in sizes (keyword arguments are passed on).
+
+    return: the timings of all sizes, and a correctness table with one row per size (frames, the largest absolute t4 and t5
+    errors in time points, and whether every cell was within tolerance).
+    """
+    timings = []
+    correctness = []
+    for n_frames in sizes:
+        results, errors = benchmark_size(n_frames, n_cells, stages, **kwargs)
+        timings.append(results)
+        correctness.append({"frames": n_frames,
+                            "max_t4_error": errors["t4_error"].abs().max(),
+                            "max_t5_error": errors["t5_error"].abs().max(),
+                            "passed": bool(errors["t4_ok"].all() and errors["t5_ok"].all() and errors["cache_ok"].all())})
+    return pd.concat(timings, ignore_index=True), pd.DataFrame(correctness)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the analysis stages on synthetic experiments and check their results.")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in SIZES), help="trace lengths in time points (default 10k to 10M)")
+    parser.add_argument("--cells", type=int, default=4, help="number of cells per experiment (default 4)")
+    parser.add_argument("--stages", default=",".join(STAGES), help="stages to run (default all: {})".format(", ".join(STAGES)))
+    parser.add_argument("--max-collate-frames", type=int, default=1000000, help="largest size for which collation is timed (default 1M)")
+    parser.add_argument("--out", default="benchmark_results.csv", help="table of timings")
+    args = parser.parse_args()
+
+    stages = args.stages.split(",")
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise SystemExit("unknown stages: {}".format(", ".join(sorted(unknown))))
+    timings, correctness = run_benchmark([int(n) for n in args.sizes.split(",")], args.cells, stages,
+                                         max_collate_frames=args.max_collate_frames)
+    timings.to_csv(args.out, index=False)
+    with pd.option_context("display.width", 200):
+        print(timings.pivot(index="stage", columns="frames", values="seconds").reindex([s for s in STAGES if s in stages]).to_string(float_format=lambda x: "{:.3g}".format(x)))
+        print(correctness.to_string(index=False))
+    sys.exit(0 if correctness["passed"].all() else 1)
@@ -0,0 +1,104 @@
+import numpy as np
+import os
+import json
+import hashlib
+
+### A disk-backed cache of derived arrays, so that repeated runs of 06 and 08 and of the parameter sweep, and runs that only change a
+### threshold, skip the Savitzky-Golay filtering. What is cached is one entry per batch of lysis windows (see
+### lysis_detection.cached_savgol_derivative): the filtered derivative of the whole batch, as one 2D array, and the peak and baseline
+### statistics of its windows. A batch is the unit because filtering and reading a single short window cost less than hashing and
+### opening a file for it.
+### The cache is content addressed: an array is stored under a hash of everything it was computed from (the data, the filter
+### parameters and the baseline), as a .npy file in CACHE_DIR, and a lookup with the same inputs returns a read-only memory-mapped
+### view of the file. Entries are never invalidated, as changed inputs give a different key.
+### The cache is bounded in size: every hit refreshes the modification time of its file, and after every write the least recently
+### used files are deleted until the cache is no larger than max_bytes.
+
+CACHE_DIR = ".derivatives"
+MAX_BYTES = 1 << 30 # 1 GiB
+
+def cache_key(*parts):
+    """
+    return: the cache key of an array computed from parts, which must be JSON serialisable.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:32]
+
+def array_digest(arr):
+    """
+    return: a hash of the contents, shape and dtype of arr, for use in a cache key.
+    """
+    arr = np.ascontiguousarray(arr)
+    digest = hashlib.sha256("{} {}".format(arr.dtype.str, arr.shape).encode())
+    digest.update(arr.data)
+    return digest.hexdigest()[:32]
+
+def cache_path(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, key + ".npy")
+
+def load_cached(key, cache_dir=CACHE_DIR):
+    """
+    return: the cached array stored under key as a read-only memory-mapped array, or None if it is not in the cache.
+    """
+    path = cache_path(key, cache_dir)
+    try:
+        arr = np.load(path, mmap_mode="r")
+    except (FileNotFoundError, ValueError):
+        return None
+    os.utime(path) # most recently used
+    return arr
+
+def store_cached(key, arr, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """
+    Stores arr in the cache under key, then evicts the least recently used entries beyond max_bytes.
+
+    return: the stored array, as a read-only memory-mapped array.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(key, cache_dir)
+    tmp = "{}.{}.tmp.npy".format(path, os.getpid()) # worker processes may write the same entry at once
+    np.save(tmp, np.asarray(arr))
+    os.replace(tmp, path)
+    evict(cache_dir, max_bytes, keep=[path])
+    return np.load(path, mmap_mode="r")
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, keep=()):
+    """
+    Deletes the least recently used entries of the cache until its total size is at most max_bytes (the paths in keep are
+    never deleted).
+
+    return: the number of entries deleted.
+    """
+    keep = set(keep)
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy") and not name.endswith(".tmp.npy"):
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError: # deleted by another process
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    deleted = 0
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        deleted += 1
+    return deleted
+
+def cache_size(cache_dir=CACHE_DIR):
+    """
+    return: the number of entries in the cache and their total size in bytes.
+    """
+    if not os.path.isdir(cache_dir):
+        return 0, 0
+    sizes = [os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir)
+             if name.endswith(".npy") and not name.endswith(".tmp.npy")]
+    return len(sizes), sum(sizes)
@@ -0,0 +1,250 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import experiment
+from pipeline import LYSIS_PARAMS, PERFORATION_PARAMS
+from plotting import render_all
+from results import RESULTS_DB, connect, run_params, upsert_results
+from sharding import shard_cells, _run_shard
+from trace_store import STORE_DIR, trace_path
+
+### A catalog of experiments, for analysing many experiments together rather than one per copy of these scripts.
+### Every experiment is registered under an id with its date and condition, and with its description (the cells, frame spacings,
+### inclusion lists and baseline adjustments that experiment.py holds for a single experiment), in 'catalog/catalog.json'. The
+### traces are stored partitioned by experiment, trench and cell ('catalog/<experiment>/trench_<t>/lysis_NN/', in the layout of
+### trace_store.py), with the adjusted approximate lysis times of each experiment in 'catalog/<experiment>/'.
+### The detection of 06 and 08 runs on any slice of the catalog (selected by id, condition and date range): the shards of all
+### selected experiments (see sharding.py) go to one pool of worker processes, and the results come back as single tables with
+### experiment, date, condition and trench columns, which are also stored in the results database (see results.py). The lysis
+### timings and perforation durations (t5 - t4) are then aggregated across experiments with a group-by over any of these columns.
+
+CATALOG_ROOT = "catalog"
+
+# the fields of an experiment description, as named in experiment.py
+DESCRIPTION_FIELDS = ["cells", "frame_spacing", "metadata_files", "clean", "fast_lysis_only", "slow_only", "baseline_offset", "start_adjust"]
+
+def catalog_path(root=CATALOG_ROOT):
+    return os.path.join(root, "catalog.json")
+
+def load_catalog(root=CATALOG_ROOT):
+    """
+    return: the catalog, {experiment_id: {"date": ..., "condition": ..., "description": {...}}}, with the cell and trench
+    numbers of every description as integers (empty if there is no catalog yet).
+    """
+    if not os.path.exists(catalog_path(root)):
+        return {}
+    with open(catalog_path(root)) as f:
+        catalog = json.load(f)
+    for entry in catalog.values():
+        description = entry["description"]
+        for field in ["cells", "metadata_files", "start_adjust"]:
+            description[field] = {int(k): v for k, v in description[field].items()}
+    return catalog
+
+def save_catalog(catalog, root=CATALOG_ROOT):
+    os.makedirs(root, exist_ok=True)
+    with open(catalog_path(root) + ".tmp", "w") as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+    os.replace(catalog_path(root) + ".tmp", catalog_path(root))
+
+def describe_experiment(module=experiment):
+    """
+    return: the description of an experiment (DESCRIPTION_FIELDS) taken from a module laid out as experiment.py.
+    """
+    return {field: getattr(module, field) for field in DESCRIPTION_FIELDS}
+
+def partition_dir(experiment_id, trench, root=CATALOG_ROOT):
+    """
+    return: the store directory holding the traces of one trench of an experiment (a store_dir for trace_store.py).
+    """
+    return os.path.join(root, experiment_id, "trench_{}".format(trench))
+
+def lysis_times_path(experiment_id, root=CATALOG_ROOT):
+    return os.path.join(root, experiment_id, "10ms_lysis_times_adjusted.csv")
+
+def register_experiment(experiment_id, date, condition, description=None, store_dir=STORE_DIR, lysis_times="10ms_lysis_times_adjusted.csv",
+                        root=CATALOG_ROOT):
+    """
+    Adds an experiment to the catalog (replacing any earlier entry with the same id), with its date (YYYY-MM-DD), condition and
+    description (default that of experiment.py), and files its traces from store_dir and its adjusted approximate lysis times into
+    the partitions of the catalog. Trace files are copied, never linked, as the store rewrites its files in place when the next
+    experiment is collated into it.
+
+    return: the number of cells filed.
+    """
+    description = description or describe_experiment()
+    catalog = load_catalog(root)
+    for k, (trench, start) in description["cells"].items():
+        source = trace_path(k, store_dir)
+        target = trace_path(k, partition_dir(experiment_id, trench, root))
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.makedirs(target)
+        for name in os.listdir(source):
+            shutil.copy2(os.path.join(source, name), os.path.join(target, name))
+    shutil.copy2(lysis_times, lysis_times_path(experiment_id, root))
+    catalog[experiment_id] = {"date": date, "condition": condition, "description": description}
+    save_catalog(catalog, root)
+    return len(description["cells"])
+
+def select_experiments(catalog, experiments=None, condition=None, date_from=None, date_to=None):
+    """
+    return: the ids of the experiments of the catalog in experiments (default all) with the given condition (default any) and a
+    date between date_from and date_to (inclusive, YYYY-MM-DD), ordered by date and id.
+    """
+    selected = []
+    for experiment_id, entry in catalog.items():
+        if experiments is not None and experiment_id not in experiments:
+            continue
+        if condition is not None and entry["condition"] != condition:
+            continue
+        if (date_from is not None and entry["date"] < date_from) or (date_to is not None and entry["date"] > date_to):
+            continue
+        selected.append(experiment_id)
+    return sorted(selected, key=lambda experiment_id: (catalog[experiment_id]["date"], experiment_id))
+
+def _experiment_tasks(experiment_id, description, lysis_params, perforation_params, auto_baseline, shard_size, root):
+    # the shards of one experiment, as tasks for sharding._run_shard
+    lysis_times = pd.read_csv(lysis_times_path(experiment_id, root))
+    lys_ts = dict(zip(lysis_times["cell"].tolist(), lysis_times["lysis_t"].tolist()))
+    cells = description["cells"]
+    lysis_cells = set(description["clean"] + description["fast_lysis_only"])
+    perforation_offsets = {k: description["baseline_offset"] + description["start_adjust"].get(k, 0)
+                           for k in cells if k in description["clean"] + description["slow_only"]}
+    included = {k: v for k, v in cells.items() if k in lysis_cells or k in perforation_offsets}
+    return [(shard, {k: lys_ts[k] for k in shard if k in lys_ts}, lysis_cells, perforation_offsets, lysis_params, perforation_params,
+             auto_baseline, partition_dir(experiment_id, cells[shard[0]][0], root)) for shard in shard_cells(included, shard_size)]
+
+def detect_catalog(selection, jobs=1, shard_size=50, lysis_params=None, perforation_params=None, auto_baseline=False, root=CATALOG_ROOT,
+                   results_path=RESULTS_DB):
+    """
+    Runs the lysis and perforation detection of 06 and 08 on the selected experiments of the catalog (a list of ids, see
+    select_experiments), with the shards of every experiment on one pool of jobs worker processes. lysis_params and
+    perforation_params override entries of pipeline.LYSIS_PARAMS and pipeline.PERFORATION_PARAMS. The results are also stored in the
+    results database at results_path (see results.py), unless it is None.
+
+    return: the cell envelope breakdown table, the perforation table and the table of failures (as returned by
+    sharding.run_sharded), each with experiment, date, condition and trench columns and sorted by experiment and cell.
+    """
+    catalog = load_catalog(root)
+    lysis_params = dict(LYSIS_PARAMS, **(lysis_params or {}))
+    perforation_params = dict(PERFORATION_PARAMS, **(perforation_params or {}))
+    tasks = []
+    owners = []
+    for experiment_id in selection:
+        experiment_tasks = _experiment_tasks(experiment_id, catalog[experiment_id]["description"], lysis_params, perforation_params,
+                                             auto_baseline, shard_size, root)
+        tasks.extend(experiment_tasks)
+        owners.extend([experiment_id] * len(experiment_tasks))
+    if jobs <= 1:
+        results = [_run_shard(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_run_shard, tasks))
+
+    tables = []
+    for i, columns in enumerate([["cell", "rise_time", "peak_time", "fall_time"],
+                                 ["cell", "start_time", "end_time", "perforation_duration", "baseline_offset"],
+                                 ["cell", "stage", "error", "traceback"]]):
+        rows = [dict(row, experiment=owner) for owner, result in zip(owners, results) for row in result[i]]
+        table = pd.DataFrame(rows, columns=["experiment"] + columns)
+        table.insert(1, "date", table["experiment"].map({e: catalog[e]["date"] for e in selection}))
+        table.insert(2, "condition", table["experiment"].map({e: catalog[e]["condition"] for e in selection}))
+        trenches = {(e, k): v[0] for e in selection for k, v in catalog[e]["description"]["cells"].items()}
+        table.insert(3, "trench", [trenches[(e, k)] for e, k in zip(table["experiment"], table["cell"])])
+        tables.append(table.sort_values(["experiment", "cell"], kind="stable").reset_index(drop=True))
+    lysis, perforation, failures = tables
+    if not auto_baseline:
+        perforation = perforation.drop(columns="baseline_offset")
+
+    if results_path:
+        conn = connect(results_path)
+        params = run_params(lysis_params, perforation_params, auto_baseline)
+        for experiment_id in selection:
+            cells = catalog[experiment_id]["description"]["cells"]
+            upsert_results(conn, "lysis", experiment_id, cells, lysis[lysis["experiment"] == experiment_id], params["lysis"])
+            upsert_results(conn, "perforation", experiment_id, cells, perforation[perforation["experiment"] == experiment_id], params["perforation"])
+        conn.close()
+    return lysis, perforation, failures
+
+def aggregate(table, columns, by=("condition",)):
+    """
+    Aggregates columns of a results table of detect_catalog (e.g. perforation_duration of the perforation table) over the groups of
+    by (any of experiment, date, condition and trench).
+
+    return: a table with one row per group and the number of events, mean, standard deviation, median, minimum and maximum of each
+    column (columns named <column>_<statistic>).
+    """
+    aggregated = table.groupby(list(by))[list(columns)].agg(["count", "mean", "std", "median", "min", "max"])
+    aggregated.columns = ["{}_{}".format(column, statistic) for column, statistic in aggregated.columns]
+    return aggregated.reset_index()
+
+def plot_experiment(experiment_id, jobs=1, force=False, root=CATALOG_ROOT, dpi=300):
+    """
+    Renders the time series plots of every cell of an experiment to 'catalog/<experiment>/plots', named after the date of the
+    experiment (see plotting.plot_path).
+
+    return: the list of cells whose plots were rendered.
+    """
+    catalog = load_catalog(root)
+    cells = catalog[experiment_id]["description"]["cells"]
+    prefix = catalog[experiment_id]["date"].replace("-", "")
+    plot_dir = os.path.join(root, experiment_id, "plots")
+    rendered = []
+    for trench in sorted(set(v[0] for v in cells.values())):
+        rendered += render_all([k for k, v in cells.items() if v[0] == trench], jobs=jobs, force=force, plot_dir=plot_dir,
+                               store_dir=partition_dir(experiment_id, trench, root), dpi=dpi, prefix=prefix)
+    return rendered
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register experiments in the catalog, and detect and aggregate events across them.")
+    parser.add_argument("--root", default=CATALOG_ROOT, help="catalog directory (default {})".format(CATALOG_ROOT))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    register = subparsers.add_parser("register", help="register the experiment of experiment.py and file its traces")
+    register.add_argument("experiment_id", nargs="?", default=experiment.experiment_id,
+                          help="name of the experiment (default that of experiment.py)")
+    register.add_argument("--date", default=experiment.date, help="date of the experiment, YYYY-MM-DD (default that of experiment.py)")
+    register.add_argument("--condition", default=experiment.condition, help="experimental condition (default that of experiment.py)")
+    subparsers.add_parser("list", help="list the registered experiments")
+    detect = subparsers.add_parser("detect", help="detect the events of a slice of the catalog and aggregate them")
+    detect.add_argument("--experiments", help="comma separated experiment ids (default all)")
+    detect.add_argument("--condition", help="only experiments with this condition")
+    detect.add_argument("--date-from", help="only experiments from this date, YYYY-MM-DD")
+    detect.add_argument("--date-to", help="only experiments up to this date, YYYY-MM-DD")
+    detect.add_argument("--by", default="condition", help="comma separated columns to aggregate over (default condition)")
+    detect.add_argument("--jobs", type=int, default=1, help="number of worker processes (default 1)")
+    detect.add_argument("--auto-baseline", action="store_true", help="choose the perforation baseline windows automatically")
+    plot = subparsers.add_parser("plot", help="plot the time series of every cell of an experiment")
+    plot.add_argument("experiment_id", help="name of the experiment")
+    plot.add_argument("--jobs", type=int, default=1, help="number of worker processes (default 1)")
+    plot.add_argument("--force", action="store_true", help="redraw plots even if they are newer than their data")
+    args = parser.parse_args()
+
+    if args.command == "register":
+        n = register_experiment(args.experiment_id, args.date, args.condition, root=args.root)
+        print("registered {} with {} cells".format(args.experiment_id, n))
+    elif args.command == "list":
+        catalog = load_catalog(args.root)
+        for experiment_id in select_experiments(catalog):
+            entry = catalog[experiment_id]
+            print("{} {} {} ({} cells)".format(entry["date"], experiment_id, entry["condition"], len(entry["description"]["cells"])))
+    elif args.command == "plot":
+        rendered = plot_experiment(args.experiment_id, jobs=args.jobs, force=args.force, root=args.root)
+        print("rendered {} plots".format(len(rendered)))
+    else:
+        catalog = load_catalog(args.root)
+        selection = select_experiments(catalog, args.experiments.split(",") if args.experiments else None, args.condition,
+                                       args.date_from, args.date_to)
+        lysis, perforation, failures = detect_catalog(selection, jobs=args.jobs, auto_baseline=args.auto_baseline, root=args.root)
+        lysis.to_csv(os.path.join(args.root, "cell_envelope_breakdown_analysis.csv"))
+        perforation.to_csv(os.path.join(args.root, "perforation_analysis.csv"))
+        failures.to_csv(os.path.join(args.root, "detection_failures.csv"))
+        by = args.by.split(",")
+        with pd.option_context("display.width", 200, "display.max_columns", 20):
+            print(aggregate(lysis, ["rise_time", "peak_time", "fall_time"], by).to_string(index=False))
+            print(aggregate(perforation, ["perforation_duration"], by).to_string(index=False))
+        print("{} experiments, {} lysis events, {} perforation events, {} failures".format(len(selection), len(lysis), len(perforation), len(failures)))
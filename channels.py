@@ -0,0 +1,121 @@
+import pandas as pd
+import numpy as np
+import os
+import argparse
+from lysis_detection import stack_lysis_windows, savgol_derivative, detect_lysis_from_derivative
+from experiment import cells, slow_only, fast_lysis_only
+from trace_store import STORE_DIR, load_trace
+
+### Event detection on all four intensity channels of each trace at once: the cell mask (c), the regions either side of the cell
+### (l and r) and the side trench (st). The +/- 2 second window around each estimated lysis time is stacked for every channel of
+### every cell into one NaN padded 2D array (one row per cell and channel), and the lysis detection of
+### '06_lysis_detection_all_data.py' runs over all rows in a single batch, giving the rise, peak and fall times of the largest
+### change on each channel.
+### The cell channel is analysed exactly as in 06 (the largest increase in intensity). On the other channels a change in either
+### direction matters (a neighbouring cell moving out of the l or r region lowers or raises its intensity, depending on what moves
+### in), so the magnitude of the derivative is used. Every event is scored by how far its peak rate stands above the baseline of
+### the derivative, in standard deviations.
+### A neighbouring cell moving into the cell mask as the envelope breaks down (the documented reason for the slow_only and
+### fast_lysis_only lists in experiment.py) changes the l or r region at the same time as the cell, so an event is flagged as a
+### neighbour intrusion when the l or r channel has a significant event (score of at least min_score) within coincidence seconds
+### of the peak on the cell channel. A coincident side trench event is reported too (st_coincident), but not flagged.
+
+CHANNELS = ["l", "c", "r", "st"]
+NEIGHBOUR_CHANNELS = ["l", "r"]
+
+def stack_channel_windows(traces, lysis_times, half_width=2, channels=CHANNELS):
+    """
+    Stacks the window [lysis_t - half_width, lysis_t + half_width) of every channel of each trace into NaN padded 2D arrays, as
+    lysis_detection.stack_lysis_windows does for a single channel. The rows are ordered by cell and then by channel.
+
+    return: cell_ids (list), time_arr and value_arr (2D arrays of shape (n_cells * n_channels, longest window), padded with NaN)
+    and lengths (the number of valid points in each row).
+    """
+    stacks = [stack_lysis_windows(traces, lysis_times, half_width, column=channel) for channel in channels]
+    cell_ids, time_arr, value_arr, lengths = stacks[0]
+    n_channels = len(channels)
+    time_arr = np.repeat(time_arr, n_channels, axis=0)
+    value_arr = np.stack([s[2] for s in stacks], axis=1).reshape(len(cell_ids) * n_channels, -1)
+    lengths = np.repeat(lengths, n_channels)
+    return cell_ids, time_arr, value_arr, lengths
+
+def detect_channels_batch(time_arr, value_arr, lengths, channels=CHANNELS, signed_channels=("c",), sg_window=8, sg_order=3, **threshold_params):
+    """
+    Applies the lysis detection algorithm (lysis_detection.detect_lysis_batch) to every row of the arrays returned by
+    stack_channel_windows. Channels not in signed_channels are analysed on the magnitude of the derivative, so that a fall in
+    intensity is found as well as a rise. threshold_params are passed on to lysis_detection.detect_lysis_from_derivative.
+
+    return: the dict of arrays of detect_lysis_batch (one entry per row), with score, the peak rate above the baseline mean in
+    baseline standard deviations.
+    """
+    dsg = savgol_derivative(value_arr, lengths, sg_window, sg_order)
+    return detect_channels_from_derivative(time_arr, dsg, lengths, channels, signed_channels, **threshold_params)
+
+def detect_channels_from_derivative(time_arr, dsg, lengths, channels=CHANNELS, signed_channels=("c",), **threshold_params):
+    """
+    The thresholding part of detect_channels_batch, starting from an already filtered derivative dsg (as returned by
+    lysis_detection.savgol_derivative, which is not modified).
+
+    return: the same dict of arrays as detect_channels_batch.
+    """
+    unsigned = np.tile([channel not in signed_channels for channel in channels], len(dsg) // len(channels))
+    dsg = dsg.copy()
+    dsg[unsigned] = np.abs(dsg[unsigned])
+    result = detect_lysis_from_derivative(time_arr, dsg, lengths, **threshold_params)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result["score"] = (result["peak_value"] - result["mu"]) / result["std"]
+    return result
+
+def events_table(cell_ids, result, channels=CHANNELS, min_score=8, coincidence=0.5):
+    """
+    return: the table of channel_events from the cell_ids and the result of detect_channels_batch.
+    """
+    n_channels = len(channels)
+    events = pd.DataFrame({"cell": cell_ids})
+    for i, channel in enumerate(channels):
+        for name in ["rise_time", "peak_time", "fall_time", "score"]:
+            events["{}_{}".format(channel, name)] = result[name][i::n_channels]
+
+    events["neighbour_intrusion"] = False
+    for channel in channels:
+        if channel == "c":
+            continue
+        with np.errstate(invalid="ignore"):
+            coincident = (events[channel + "_score"] >= min_score) & ((events[channel + "_peak_time"] - events["c_peak_time"]).abs() <= coincidence)
+        events[channel + "_coincident"] = coincident
+        if channel in NEIGHBOUR_CHANNELS:
+            events["neighbour_intrusion"] |= coincident
+    return events
+
+def channel_events(traces, lysis_times, channels=CHANNELS, half_width=2, min_score=8, coincidence=0.5, **lysis_params):
+    """
+    Detects the events on every channel of the traces ({cell: trace with "time" and the channel columns}) around the estimated
+    lysis times ({cell: time}) in one batch (see detect_channels_batch, lysis_params are passed on), and flags neighbour intrusions
+    from the timing of the events (see the top of this file). channels must include "c".
+
+    return: a table with one row per cell: the rise_time, peak_time, fall_time and score of each channel (columns prefixed with the
+    channel name, e.g. l_peak_time), a <channel>_coincident column for each channel other than c, and neighbour_intrusion.
+    """
+    cell_ids, time_arr, value_arr, lengths = stack_channel_windows(traces, lysis_times, half_width, channels)
+    result = detect_channels_batch(time_arr, value_arr, lengths, channels, **lysis_params)
+    return events_table(cell_ids, result, channels, min_score, coincidence)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect the events on all intensity channels and flag neighbour intrusions.")
+    parser.add_argument("--out", default="dataframes/channel_events.csv", help="table of per-channel events")
+    parser.add_argument("--min-score", type=float, default=8, help="smallest significant event score, in standard deviations (default 8)")
+    parser.add_argument("--coincidence", type=float, default=0.5, help="largest time between coincident events, in seconds (default 0.5)")
+    args = parser.parse_args()
+
+    lysis_times_adjusted = pd.read_csv("10ms_lysis_times_adjusted.csv")
+    lys_ts = dict(zip(lysis_times_adjusted["cell"], lysis_times_adjusted["lysis_t"]))
+    traces = {k: load_trace(k, columns=["time"] + CHANNELS, store_dir=STORE_DIR) for k in cells if k in lys_ts}
+    events = channel_events(traces, lys_ts, min_score=args.min_score, coincidence=args.coincidence)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    events.to_csv(args.out)
+
+    flagged = events["cell"][events["neighbour_intrusion"]].tolist()
+    excluded = sorted(slow_only + fast_lysis_only)
+    print("neighbour intrusion flagged for cells: {}".format(flagged))
+    print("excluded from the lysis analysis by inspection: {}".format(excluded))
+    print("flagged but not excluded: {}, excluded but not flagged: {}".format(sorted(set(flagged) - set(excluded)), sorted(set(excluded) - set(flagged))))
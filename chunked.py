@@ -0,0 +1,65 @@
+import numpy as np
+from crossing import find_crossing_points
+
+### Out-of-core processing of full length traces, for acquisitions of any number of time points.
+### The stored traces are memory-mapped (see trace_store.py), so a trace never has to be read into memory as a whole: the functions
+### here read and process it in chunks of chunk_size points. Filters need the neighbouring points of each chunk, so every chunk is
+### read with a halo of extra points on either side, sized for the filter window, and only the core of the chunk is kept. The halo
+### is at least as long as the filter window, so the core of every chunk is filtered exactly as in the full trace (including the
+### polynomial fit at the two ends of the trace, which falls inside the first and last chunks), and the results are identical to
+### processing the whole trace in memory.
+### scipy is only imported by the filters, so that the modules using the crossing search alone (perforation detection, plotting)
+### start without it.
+
+CHUNK_SIZE = 1000000
+
+def chunk_bounds(n, chunk_size=CHUNK_SIZE, halo=0):
+    """
+    A generator over the chunks of a trace of n points, yielding (lo, hi, core_lo, core_hi): the chunk is read from lo to hi,
+    which includes up to halo points either side of its core, and the core (core_lo to core_hi, relative to the trace) is the
+    part of the result it contributes. The cores cover the trace exactly once.
+    """
+    for core_lo in range(0, n, chunk_size):
+        core_hi = min(core_lo + chunk_size, n)
+        yield max(core_lo - halo, 0), min(core_hi + halo, n), core_lo, core_hi
+
+def chunked_savgol_derivative(value_arr, sg_window=8, sg_order=3, chunk_size=CHUNK_SIZE, out=None):
+    """
+    Computes the derivative of the Savitzky-Golay filtered intensity of a full trace, as
+    np.concatenate(([0], np.diff(savgol_filter(value_arr, sg_window, sg_order)))) (see lysis_detection.savgol_derivative), in chunks
+    of chunk_size points. out is an optional array to write the result into.
+
+    return: the derivative array (out, if given).
+    """
+    from scipy.signal import savgol_filter
+    if out is None:
+        out = np.empty(len(value_arr))
+    # the difference at the first point of a chunk also needs the filtered value of the point before it, hence the longer halo
+    for lo, hi, core_lo, core_hi in chunk_bounds(len(value_arr), chunk_size, sg_window + 1):
+        sg = savgol_filter(np.asarray(value_arr[lo:hi], dtype=float), sg_window, sg_order)
+        if core_lo == 0:
+            out[0] = 0
+            out[1:core_hi] = np.diff(sg[:core_hi - lo])
+        else:
+            out[core_lo:core_hi] = np.diff(sg[core_lo - 1 - lo:core_hi - lo])
+    return out
+
+def chunked_crossing_point(value_arr, threshold_value, window_length, start_idx=0, mode="increasing", chunk_size=CHUNK_SIZE):
+    """
+    Finds the first index at or after start_idx where value_arr crosses threshold_value for a minimum of window_length consecutive
+    time points, as crossing.find_crossing_points does for a single trace, but reading the trace in chunks of chunk_size points
+    (overlapping by window_length - 1 points, so that runs spanning two chunks are found) and stopping at the first chunk with a
+    crossing. Only the part of the trace up to the crossing is ever read.
+
+    return: the crossing index, or -1 if the end of the trace is reached without a crossing.
+    """
+    n = len(value_arr)
+    start_idx = max(int(start_idx), 0)
+    for lo in range(start_idx, n, chunk_size):
+        hi = min(lo + chunk_size + window_length - 1, n)
+        idx = int(find_crossing_points(value_arr[lo:hi], threshold_value, window_length, mode=mode)[0])
+        if idx >= 0:
+            return lo + idx
+        if hi == n:
+            break
+    return -1
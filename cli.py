@@ -0,0 +1,124 @@
+import os
+import sys
+import argparse
+
+### A single command line entry point for the analysis steps of scripts 01, 04, 06, 08 and 02, for running them as short tasks
+### (e.g. one cluster array job per trench or per group of cells) rather than as whole scripts:
+###     python cli.py collate [--cells 1-7] [--jobs N] [--out lysis_data_time_adjusted]
+###     python cli.py adjust-times [--out 10ms_lysis_times_adjusted.csv]
+###     python cli.py detect-lysis [--cells ...] [--jobs N] [--out dataframes/cell_envelope_breakdown_analysis.csv]
+###     python cli.py detect-perforation [--cells ...] [--jobs N] [--out dataframes/perforation_analysis.csv]
+###     python cli.py plot [--cells ...] [--jobs N] [--out time_series_plots]
+### Only the standard library is imported at startup, and each subcommand imports the modules it needs when it runs, so a task
+### never pays for libraries it does not use (e.g. matplotlib outside plot, scipy outside the detection steps). --cells takes a
+### comma separated list of cells and ranges of cells of experiment.py (default all of them); the inclusion lists of experiment.py
+### still apply to the detection steps. The detection steps run sharded by trench on --jobs worker processes (see sharding.py), and
+### write any per-cell failures next to their output ('<out>_failures.csv').
+
+def parse_cells(text, cells):
+    """
+    Parses a list of cells such as "1,2,5-9" (ranges are inclusive and may span cells missing from the experiment, but single
+    cells must exist), keeping the cells present in cells (experiment.cells).
+
+    return: a dict {cell_number: [trench_number, start_timepoint]} of the selected cells, in the order of cells.
+    """
+    if text is None:
+        return dict(cells)
+    selected = set()
+    for part in text.split(","):
+        if "-" in part:
+            lo, hi = part.split("-")
+            selected.update(range(int(lo), int(hi) + 1))
+        elif part.strip():
+            if int(part) not in cells:
+                raise SystemExit("unknown cell: {}".format(part))
+            selected.add(int(part))
+    return {k: v for k, v in cells.items() if k in selected}
+
+def _write_failures(failures, out):
+    path = os.path.splitext(out)[0] + "_failures.csv"
+    if len(failures):
+        failures.to_csv(path)
+        print("{} failures (see {})".format(len(failures), path), file=sys.stderr)
+    elif os.path.exists(path):
+        os.remove(path) # from an earlier run
+
+def collate(args):
+    from collate import collate_cells
+    from trace_store import STORE_DIR
+    from experiment import cells, frame_spacing, metadata_files
+    n_rows = collate_cells(parse_cells(args.cells, cells), frame_spacing, jobs=args.jobs, input_dir=args.input_dir,
+                           store_dir=args.out or STORE_DIR, write_csv=args.csv, metadata_files=metadata_files)
+    print("collated {} cells".format(len(n_rows)))
+
+def adjust_times(args):
+    import pandas as pd
+    from collate import adjust_lysis_times
+    from experiment import cells, frame_spacing, metadata_files
+    lysis_times = pd.read_csv(os.path.join(args.input_dir, "10ms_lysis_times.csv"))
+    lysis_times_adjusted = adjust_lysis_times(lysis_times, parse_cells(args.cells, cells), frame_spacing, metadata_files)
+    lysis_times_adjusted.to_csv(args.out or "10ms_lysis_times_adjusted.csv")
+
+def detect_lysis(args):
+    from sharding import run_sharded
+    from experiment import cells
+    out = args.out or "dataframes/cell_envelope_breakdown_analysis.csv"
+    cell_envelope_breakdown_analysis, perforation_analysis, failures = run_sharded(
+        parse_cells(args.cells, cells), jobs=args.jobs, lysis_times_path=args.lysis_times, perforation=False)
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    cell_envelope_breakdown_analysis.to_csv(out)
+    _write_failures(failures, out)
+
+def detect_perforation(args):
+    from sharding import run_sharded
+    from experiment import cells
+    out = args.out or "dataframes/perforation_analysis.csv"
+    cell_envelope_breakdown_analysis, perforation_analysis, failures = run_sharded(
+        parse_cells(args.cells, cells), jobs=args.jobs, auto_baseline=args.auto_baseline, lysis_times_path=args.lysis_times)
+    if not args.auto_baseline:
+        perforation_analysis = perforation_analysis.drop(columns="baseline_offset")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    perforation_analysis.to_csv(out)
+    _write_failures(failures, out)
+
+def plot(args):
+    from plotting import PLOT_DIR, render_all
+    from experiment import cells, date
+    selected = parse_cells(args.cells, cells)
+    rendered = render_all(selected.keys(), jobs=args.jobs, force=args.force, plot_dir=args.out or PLOT_DIR, prefix=date.replace("-", ""))
+    print("rendered {} plots, {} up to date".format(len(rendered), len(selected) - len(rendered)))
+
+COMMANDS = {"collate": (collate, "collate and time adjust the Fiji region intensity files (01)"),
+            "adjust-times": (adjust_times, "convert the approximate lysis time points to seconds (04)"),
+            "detect-lysis": (detect_lysis, "detect the start of lysis of the included events (06)"),
+            "detect-perforation": (detect_perforation, "detect the start and duration of perforation of the included events (08)"),
+            "plot": (plot, "plot the time series of every cell (02)")}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one step of the perforation and lysis analysis.")
+    parser.add_argument("--profile", nargs="?", const="profile", metavar="DIR", help="record a profile of the run in DIR (default profile)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (func, help) in COMMANDS.items():
+        sub = subparsers.add_parser(name, help=help, description=help)
+        sub.add_argument("--cells", help="cells to process, e.g. 1,2,5-9 (default all cells of experiment.py)")
+        sub.add_argument("--jobs", type=int, default=1, help="number of worker processes (default 1)")
+        sub.add_argument("--out", help="output file or directory (default that of the script)")
+        if name in ["collate", "adjust-times"]:
+            sub.add_argument("--input-dir", default=".", help="directory holding the input files (default .)")
+        if name == "collate":
+            sub.add_argument("--csv", action="store_true", help="also write the legacy lysis_NN.csv files")
+        if name in ["detect-lysis", "detect-perforation"]:
+            sub.add_argument("--lysis-times", default="10ms_lysis_times_adjusted.csv", help="table of approximate lysis times")
+        if name == "detect-perforation":
+            sub.add_argument("--auto-baseline", action="store_true", help="choose the perforation baseline windows automatically")
+        if name == "plot":
+            sub.add_argument("--force", action="store_true", help="redraw plots even if they are newer than their data")
+        sub.set_defaults(func=func)
+    args = parser.parse_args(argv)
+    if args.profile:
+        import profiling
+        profiling.enable(args.profile)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
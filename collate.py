@@ -0,0 +1,98 @@
+import pandas as pd
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from trace_store import STORE_DIR, save_trace, export_csv
+from timestamps import frame_times
+from profiling import profiled
+
+### Ingestion of the Fiji region intensity files ('lys_NN_l.csv', 'lys_NN_c.csv', 'lys_NN_r.csv' and 'lys_NN_st.csv') into the trace store.
+### Each cell is read, checked, time adjusted and written to the store by a single worker, and only a short summary is returned,
+### so cells can be collated concurrently on a process pool while at most one cell per worker is held in memory.
+### The approximate lysis times are time adjusted here too (see '04_time_adjust_approximate_lysis_times.py').
+
+REGIONS = ["l", "c", "r", "st"]
+
+def region_path(cell, region, input_dir="."):
+    """
+    return: the path of the Fiji intensity profile file for one region of cell.
+    """
+    return os.path.join(input_dir, "lys_{}_{}.csv".format(str(cell).zfill(2), region))
+
+@profiled("read_region_files", cell_arg="cell")
+def read_region_files(cell, input_dir="."):
+    """
+    Reads the four region files of a cell, keeping only the Slice and Mean columns. The Slice columns of the four files must
+    agree (same length and same slices), otherwise the regions cannot be aligned in time and a ValueError is raised.
+
+    return: slices (1D array of the Fiji slice numbers, starting at 1) and means, a dict {region: 1D array of mean intensities}.
+    """
+    slices = None
+    means = {}
+    for region in REGIONS:
+        path = region_path(cell, region, input_dir)
+        d = pd.read_csv(path, usecols=["Slice", "Mean"])
+        s = np.asarray(d["Slice"], dtype=np.int64)
+        if slices is None:
+            slices = s
+        elif len(s) != len(slices):
+            raise ValueError("{} has {} slices but {} has {}".format(path, len(s), region_path(cell, REGIONS[0], input_dir), len(slices)))
+        elif not np.array_equal(s, slices):
+            raise ValueError("{} covers different slices to {}".format(path, region_path(cell, REGIONS[0], input_dir)))
+        means[region] = np.asarray(d["Mean"], dtype=np.float64)
+    return slices, means
+
+@profiled("collate_cell", cell_arg="cell")
+def collate_cell(cell, trench, start_timepoint, frame_spacing, input_dir=".", store_dir=STORE_DIR, write_csv=False, metadata_path=None):
+    """
+    Collates the region files of one cell, adjusts the time axis with the frame spacing of its trench
+    (time = (timepoint + start_timepoint) * frame_spacing), or with the recorded frame timestamps if the metadata file of the trench
+    is given as metadata_path (see timestamps.frame_times), and saves the result to the trace store.
+    If write_csv is True the legacy 'lysis_NN.csv' file is exported as well.
+
+    return: (cell, number of time points written).
+    """
+    slices, means = read_region_files(cell, input_dir)
+    d = {}
+    d["timepoint"] = slices - 1
+    d["time"] = frame_times(d["timepoint"] + start_timepoint, frame_spacing, metadata_path)
+    for region in REGIONS:
+        d[region] = means[region]
+    save_trace(cell, trench, d, store_dir)
+    if write_csv:
+        export_csv(cell, store_dir=store_dir)
+    return cell, len(slices)
+
+def _collate_cell_star(args):
+    return collate_cell(*args)
+
+def collate_cells(cells, frame_spacing, jobs=1, input_dir=".", store_dir=STORE_DIR, write_csv=False, metadata_files=None):
+    """
+    Collates every cell in cells ({cell_number: [trench_number, start_timepoint]}), where frame_spacing is the list of
+    trench frame spacings (trench 1 first) and metadata_files an optional dict {trench_number: metadata file} of the trenches
+    whose frame timestamps should be used instead. With jobs > 1 the cells are processed on a pool of jobs worker processes;
+    each worker writes its cells straight to the store, so results are streamed to disk as they complete.
+
+    return: a dict {cell: number of time points written}.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    metadata_files = metadata_files or {}
+    tasks = [(k, v[0], v[1], frame_spacing[v[0] - 1], input_dir, store_dir, write_csv, metadata_files.get(v[0])) for k, v in cells.items()]
+    if jobs <= 1:
+        return dict(_collate_cell_star(t) for t in tasks)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return dict(executor.map(_collate_cell_star, tasks))
+
+def adjust_lysis_times(lysis_times, cells, frame_spacing, metadata_files=None):
+    """
+    Converts the approximate lysis time points in lysis_times (the lysis_t_start column of the table '10ms_lysis_times.csv') to times
+    in seconds using the true frame spacing of each trench, rather than the nominal 10 ms, or the recorded frame timestamps for the
+    trenches in metadata_files ({trench_number: metadata file}).
+
+    return: a copy of the rows of lysis_times for the cells in cells, with the adjusted time in seconds in a new column lysis_t.
+    """
+    lysis_times_adjusted = lysis_times[lysis_times["cell"].isin(cells.keys())].copy()
+    metadata_files = metadata_files or {}
+    lysis_times_adjusted["lysis_t"] = [float(frame_times(t, frame_spacing[cells[k][0] - 1], metadata_files.get(cells[k][0])))
+                                       for k, t in zip(lysis_times_adjusted["cell"], lysis_times_adjusted["lysis_t_start"])]
+    return lysis_times_adjusted
@@ -0,0 +1,69 @@
+import numpy as np
+from profiling import profiled
+
+### Shared threshold crossing detection for the lysis and perforation scripts (05 to 08).
+### The original find_crossing_point walked the array one sample at a time in a Python while loop. Here the same criterion
+### (the first run of window_length consecutive samples above or below a threshold) is found with a cumulative sum over a
+### boolean array, so that a whole batch of traces can be processed at once with per-trace thresholds and start indices.
+
+@profiled("find_crossing_points")
+def find_crossing_points(value_arr, threshold_values, window_length, start_idx=0, mode="increasing"):
+    """
+    A batched function for finding when each row of a 2D array of time series (value_arr, shape (n_traces, n_timepoints))
+    crosses its threshold (threshold_values, a scalar or one value per row) for a minimum of window_length consecutive time points.
+    start_idx may be a scalar or one index per row; samples before start_idx are ignored, as in find_crossing_point, and negative
+    start indices are treated as zero. The mode can be set to "increasing" (default) to find when a trace rises above its threshold,
+    or to any other value (e.g. "decreasing") to find when it falls below it.
+    Traces of different lengths can be batched by padding with NaN, as NaN never counts towards a crossing.
+
+    The run of consecutive points is found from the cumulative sum of the boolean crossing array: a window of window_length
+    points ending at index j lies fully beyond the threshold exactly when the cumulative sum increases by window_length over it.
+
+    return: crossing_idx, an integer array holding, for each row, the first index at which the trace crosses the threshold for
+    a minimum of window_length consecutive time points, or -1 if the end of the trace is reached without a crossing.
+    """
+    value_arr = np.asarray(value_arr, dtype=float)
+    if value_arr.ndim == 1:
+        value_arr = value_arr[np.newaxis, :]
+    n_traces, n_timepoints = value_arr.shape
+    threshold_values = np.broadcast_to(np.asarray(threshold_values, dtype=float), (n_traces,))
+    start_idx = np.clip(np.broadcast_to(np.asarray(start_idx, dtype=np.int64), (n_traces,)), 0, None)
+    if window_length < 1:
+        raise ValueError("window_length must be at least 1, got {}".format(window_length))
+    if n_timepoints < window_length:
+        return np.full(n_traces, -1, dtype=np.int64)
+
+    with np.errstate(invalid="ignore"):
+        if mode == "increasing":
+            crossed = value_arr > threshold_values[:, np.newaxis]
+        else:
+            crossed = value_arr < threshold_values[:, np.newaxis]
+    crossed &= np.arange(n_timepoints)[np.newaxis, :] >= start_idx[:, np.newaxis]
+
+    # cumulative count of crossed points, with a leading zero so that the count over [j - window_length + 1, j] is a simple difference
+    counts = np.zeros((n_traces, n_timepoints + 1), dtype=np.int32)
+    np.cumsum(crossed, axis=1, out=counts[:, 1:])
+    full_window = (counts[:, window_length:] - counts[:, :-window_length]) == window_length
+
+    # full_window[:, i] is True when the window starting at index i is entirely beyond the threshold
+    found = full_window.any(axis=1)
+    crossing_idx = np.where(found, np.argmax(full_window, axis=1), -1)
+    return crossing_idx
+
+def find_crossing_point(time_arr, value_arr, threshold_value, window_length, start_idx=0, mode="increasing"):
+    """
+    A general function for finding when a time series (value_arr) crosses threshold_value for a minimum of
+    window_length number of time points. The starting index is specified by start_idx if error causing or
+    irrelevant data in the array needs to be skipped over. The mode can be set to "increasing" (default) if
+    you wish to find when an array increases above a threshold, or set to a different value (e.g "decreasing")
+    if you wish to find when it decreases below a threshold.
+    This is the single trace form of find_crossing_points.
+
+    return: crossing_idx, the first index at which the array crosses the threshold for a minimum of window_length
+    consecutive time points. Also returns the corresponding time.
+    If the function reaches the end of the array without meeting the threshold crossing conditions, return None.
+    """
+    crossing_idx = int(find_crossing_points(value_arr, threshold_value, window_length, start_idx=start_idx, mode=mode)[0])
+    if crossing_idx < 0:
+        return None
+    return crossing_idx, np.asarray(time_arr)[crossing_idx]
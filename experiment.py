@@ -0,0 +1,100 @@
+import json
+
+### The experiment description shared by the analysis scripts (01 to 08) and the pipeline runner (pipeline.py):
+### the cells analysed, the frame spacing of each trench, the event inclusion lists and the per-cell baseline adjustments.
+
+# Create an index to help load in the intensity data.
+# As the masks are static and the cells sometimes move in the time period leading up to lysis,
+# the start_timepoint is adjusted to be at a suitable start time for the analysis.
+# cells = {cell_number: [trench_number, start_timepoint]}
+cells = {1: [1, 0],
+         2: [1, 0],
+         3: [1, 0],
+         4: [1, 0],
+         5: [1, 10000],
+         6: [1, 30000],
+         7: [1, 30000],
+         9: [2, 0],
+         10: [2, 0],
+         11: [2, 0],
+         12: [2, 0],
+         13: [2, 0],
+         15: [2, 10000],
+         16: [2, 10000],
+         17: [2, 20000],
+         18: [2, 20000],
+         19: [2, 60000],
+         20: [3, 0],
+         22: [3, 0],
+         23: [3, 0],
+         24: [3, 0],
+         25: [3, 10000],
+         26: [3, 10000],
+         27: [3, 10000],
+         28: [3, 10000],
+         29: [3, 10000],
+         30: [3, 0],
+         31: [3, 20000],
+         32: [4, 10000],
+         33: [4, 10000],
+         34: [4, 10000],
+         35: [4, 10000],
+         36: [4, 10000],
+         38: [4, 10000],
+         39: [4, 10000],
+         40: [4, 20000],
+         41: [4, 20000],
+         42: [4, 0],
+         43: [5, 0],
+         44: [5, 30000],
+         45: [5, 60000],
+         46: [5, 60000],
+         47: [5, 60000],
+         48: [5, 60000]}
+
+# adjust timings in each trench by the temporal frame spacing to correct for the 1.3 to 2.0% error in frame spacing on 10 ms
+# temporal frame spacings found also in image metadata (along with coefficient of variation).
+trench_1_fs = 0.010192040380847209 # frame spacing in seconds
+trench_2_fs = 0.010131019743528872
+trench_3_fs = 0.01018282972445327
+trench_4_fs = 0.01020342320864684
+trench_5_fs = 0.010183534963434706
+frame_spacing = [trench_1_fs, trench_2_fs, trench_3_fs, trench_4_fs, trench_5_fs]
+
+# the image metadata .txt file of each trench, {trench_number: path}. For the trenches listed here the time axis is built from the
+# recorded timestamp of every frame (see timestamps.py) instead of the mean frame spacing above.
+metadata_files = {}
+
+# the name under which the results of this experiment are stored (see results.py)
+experiment_id = "10ms_lysis"
+date = "2023-08-11" # YYYY-MM-DD, also the prefix of the plot file names (see plotting.py)
+condition = "10ms_lysis" # the experimental condition, for aggregating results across experiments (see catalog.py)
+
+# the inclusion lists for events (see '10ms_lysis_fiji_data_summary.csv' for the reasons for exclusion)
+clean = [1,2,3,4,6,7,9,10,12,13,15,16,17,18,19,23,24,25,26,27,28,29,30,31,34,35,36,38,39,40,41,42,43,44,45,47] # clean for both perforation and lysis
+fast_lysis_only = [33,48] # events where slow lysis excluded but fast lysis included
+slow_only = [5,11,20,22,46] # events where fast lysis excluded but slow lysis (perforation) included
+
+# set to the inclusion lists generated from the QC features of the events by qc.py (e.g. "dataframes/qc_inclusion_lists.json") to use
+# them in place of the hand curated lists above
+qc_inclusion_lists = None
+if qc_inclusion_lists is not None:
+    with open(qc_inclusion_lists) as f:
+        generated = json.load(f)
+    clean, fast_lysis_only, slow_only = generated["clean"], generated["fast_lysis_only"], generated["slow_only"]
+
+# the perforation baseline window starts baseline_offset time points (approximately 10 seconds) before the maximal rate of contrast loss.
+# the start_adjust ensures that the algorithm for perforation detection starts at an appropriate time (reasoning explained at start of script '07_perforation_detection_algorithm_testing.py')
+baseline_offset = 1000
+start_adjust = {1: 500,
+                3: 300,
+                5: 100,
+                11: 200,
+                16: -200,
+                18: 2000,
+                19: 2000,
+                24: 500,
+                29: -200,
+                30: -200,
+                39: 500,
+                45: 500}
@@ -0,0 +1,252 @@
+import pandas as pd
+import numpy as np
+import os
+import re
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from scipy.fft import next_fast_len
+from collate import REGIONS, region_path
+from experiment import cells
+
+### Extraction of the region intensity files ('lys_NN_l.csv', 'lys_NN_c.csv', 'lys_NN_r.csv' and 'lys_NN_st.csv', as read by
+### '01_time_adjust_data.py') straight from the phase contrast image sequence, replacing the Fiji 'Import image sequence' and
+### intensity profile steps (which had to be run in stacks of 10000 time points, see '03_trim_oversized_data.py').
+### The masks are static, so every region of every cell in a trench is a fixed set of pixels. The frames of the trench are decoded
+### on a pool of threads in chunks of chunk_size frames, cropped to the bounding box of all masks, and the means of all regions of
+### all cells are found for the whole chunk at once as one matrix product with the (normalised) masks, and appended to the region
+### files before the next chunk is decoded. Only one chunk of frames and its means are held in memory at a time, so stacks of any
+### length can be extracted in one go. Each frame is decoded once, however many cells share the trench.
+### The masks are given in a JSON file {cell: {region: [x, y, width, height]}} of rectangles in pixels (as reported by Fiji for a
+### rectangular selection), or {cell: {region: "mask.npy"}} for arbitrary boolean masks saved with numpy.
+### Cells sometimes move along the trench before lysis, which with static masks is why the analysis starts at a hand-chosen
+### start_timepoint for some cells and uses start_adjust for the perforation baseline (see experiment.py). With --register, the
+### drift of each cell is followed instead: the intensity profile along the trench around the cell's l, c and r masks is
+### cross-correlated (with FFTs, for a whole chunk of frames at once) against the profile in the first frame, and the three masks
+### are moved by the drift found in each frame before the means are taken. The side trench mask stays static.
+
+FRAME_PATTERN = r"xy000_PC_T(\d+)\.png"
+
+def list_frames(image_dir, pattern=FRAME_PATTERN, first_timepoint=0, last_timepoint=None):
+    """
+    Finds the frames in image_dir whose file names match pattern, where the first group of pattern is the time point.
+    Only the time points from first_timepoint to last_timepoint (inclusive, None for the end of the sequence) are kept.
+
+    return: timepoints (1D int array, ascending) and paths (list of file paths in the same order).
+    """
+    regex = re.compile(pattern)
+    frames = []
+    for name in os.listdir(image_dir):
+        match = regex.fullmatch(name)
+        if match:
+            t = int(match.group(1))
+            if t >= first_timepoint and (last_timepoint is None or t <= last_timepoint):
+                frames.append((t, os.path.join(image_dir, name)))
+    frames.sort()
+    return np.asarray([t for t, path in frames], dtype=np.int64), [path for t, path in frames]
+
+def rectangle_mask(shape, x, y, width, height):
+    """
+    return: a boolean mask of the given image shape (rows, columns) selecting the rectangle with top left corner (x, y).
+    """
+    mask = np.zeros(shape, dtype=bool)
+    mask[y:y + height, x:x + width] = True
+    return mask
+
+def load_masks(path, shape):
+    """
+    Reads the masks JSON file at path (see the top of this file) for images of the given shape. Relative .npy paths are taken
+    relative to the JSON file.
+
+    return: a dict {(cell, region): boolean mask}.
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    masks = {}
+    for cell, regions in spec.items():
+        for region, value in regions.items():
+            if region not in REGIONS:
+                raise ValueError("unknown region {} for cell {} in {}".format(region, cell, path))
+            if isinstance(value, str):
+                mask = np.load(os.path.join(os.path.dirname(path), value)).astype(bool)
+                if mask.shape != tuple(shape):
+                    raise ValueError("mask {} has shape {} but the images have shape {}".format(value, mask.shape, tuple(shape)))
+            else:
+                mask = rectangle_mask(shape, *value)
+            if not mask.any():
+                raise ValueError("the {} mask of cell {} in {} is empty".format(region, cell, path))
+            masks[(int(cell), region)] = mask
+    return masks
+
+def read_frame(path):
+    """
+    return: the image at path as a 2D array, keeping its bit depth.
+    """
+    from PIL import Image
+    with Image.open(path) as image:
+        return np.asarray(image)
+
+def shift_mask(mask, shift, axis=1):
+    """
+    return: a copy of the boolean mask moved by shift pixels along axis (towards higher indices for positive shift), with the
+    pixels moved in from outside the image left empty.
+    """
+    shifted = np.zeros_like(mask)
+    n = mask.shape[axis]
+    src = [slice(None)] * mask.ndim
+    dst = [slice(None)] * mask.ndim
+    src[axis] = slice(max(-shift, 0), n - max(shift, 0))
+    dst[axis] = slice(max(shift, 0), n - max(-shift, 0))
+    shifted[tuple(dst)] = mask[tuple(src)]
+    return shifted
+
+def profile_shifts(profiles, reference, max_shift=20):
+    """
+    Finds the shift of each intensity profile (the rows of the 2D array profiles) relative to the 1D reference profile, as the lag
+    between -max_shift and max_shift of the highest cross-correlation. The cross-correlations of all profiles are computed at once
+    with FFTs, zero padded so that the correlation does not wrap around.
+
+    return: an integer array with the shift of each profile, in pixels (positive if the profile has moved towards higher indices).
+    """
+    n = profiles.shape[1]
+    n_fft = next_fast_len(n + max_shift + 1)
+    p = profiles - profiles.mean(axis=1, keepdims=True)
+    r = reference - reference.mean()
+    corr = np.fft.irfft(np.fft.rfft(p, n_fft, axis=1) * np.conj(np.fft.rfft(r, n_fft)), n_fft, axis=1)
+    lags = np.arange(-max_shift, max_shift + 1)
+    return lags[np.argmax(corr[:, lags % n_fft], axis=1)]
+
+def region_means(paths, masks, chunk_size=1000, threads=8, groups=None, max_shift=20, trench_axis=1):
+    """
+    A generator over the frames in paths, yielding for each chunk of chunk_size frames a 2D array (frames, masks) of the mean
+    intensity inside every mask of masks (a list of boolean masks, all of the frame shape), and a 2D array (frames, groups) of the
+    mask shifts. Frames are decoded on a pool of threads threads.
+    groups is an optional list of lists of indices into masks (e.g. the l, c and r masks of one cell) to be registered: the
+    intensity profile along the trench (image axis trench_axis) over the bounding box of each group, widened by max_shift, is
+    compared with the profile in the first frame (see profile_shifts), and the masks of the group are moved by the drift found
+    before the means are taken. Masks in no group are static.
+    """
+    groups = groups or []
+    other_axis = 1 - trench_axis
+    union = np.any(masks, axis=0)
+    for group in groups:
+        union |= np.any([shift_mask(masks[i], s, trench_axis) for i in group for s in [-max_shift, max_shift]], axis=0)
+    rows = np.flatnonzero(union.any(axis=1))
+    cols = np.flatnonzero(union.any(axis=0))
+    box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    cropped = [m[box] for m in masks]
+    weights = np.stack([m.ravel() / m.sum() for m in cropped], axis=1) # (box pixels, masks), each column sums to 1
+
+    # the profile box of each group, in cropped coordinates
+    group_boxes = []
+    for group in groups:
+        g = np.any([shift_mask(cropped[i], s, trench_axis) for i in group for s in [-max_shift, max_shift]], axis=0)
+        r = np.flatnonzero(g.any(axis=1))
+        c = np.flatnonzero(g.any(axis=0))
+        group_boxes.append((slice(None), slice(r[0], r[-1] + 1), slice(c[0], c[-1] + 1)))
+    references = [None] * len(groups)
+    shifted_weights = {}
+
+    def read_cropped(path):
+        frame = read_frame(path)
+        if frame.shape != union.shape:
+            raise ValueError("{} has shape {} but the masks have shape {}".format(path, frame.shape, union.shape))
+        return frame[box]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for i in range(0, len(paths), chunk_size):
+            chunk = np.stack(list(executor.map(read_cropped, paths[i:i + chunk_size]))).astype(np.float64)
+            flat = chunk.reshape(len(chunk), -1)
+            means = flat @ weights
+            shifts = np.zeros((len(chunk), len(groups)), dtype=np.int64)
+            for j, (group, group_box) in enumerate(zip(groups, group_boxes)):
+                profiles = chunk[group_box].mean(axis=1 + other_axis)
+                if references[j] is None:
+                    references[j] = profiles[0]
+                shifts[:, j] = profile_shifts(profiles, references[j], max_shift)
+                for shift in np.unique(shifts[:, j]):
+                    frames = shifts[:, j] == shift
+                    for m in group:
+                        if (m, shift) not in shifted_weights:
+                            moved = shift_mask(cropped[m], int(shift), trench_axis)
+                            shifted_weights[(m, shift)] = moved.ravel() / moved.sum()
+                        means[frames, m] = flat[frames] @ shifted_weights[(m, shift)]
+            yield means, shifts
+
+def extract_trench(image_dir, masks, first_timepoints=None, pattern=FRAME_PATTERN, last_timepoint=None, output_dir=".",
+                   chunk_size=1000, threads=8, register=False, max_shift=20, trench_axis=1):
+    """
+    Extracts the region intensity files of every cell with masks in masks ({(cell, region): boolean mask}) from the image
+    sequence of one trench in image_dir. The file of each cell starts at its time point in first_timepoints ({cell: time point},
+    the start_timepoint of experiment.cells; 0 if missing), and runs to last_timepoint or the end of the sequence. The files
+    have the Slice (numbered from 1 at the first time point) and Mean columns of the Fiji output.
+    With register=True the l, c and r masks of each cell follow the drift of the cell along the trench (up to max_shift pixels
+    from its position in the first frame, see region_means), and the drift is written to 'lys_NN_drift.csv' (Slice and Shift columns).
+
+    return: a dict {cell: number of time points written}.
+    """
+    first_timepoints = first_timepoints or {}
+    keys = sorted(masks)
+    extracted_cells = sorted(set(k for k, region in keys))
+    start = min(first_timepoints.get(k, 0) for k in extracted_cells)
+    timepoints, paths = list_frames(image_dir, pattern, start, last_timepoint)
+    if len(paths) == 0:
+        raise ValueError("no frames matching {} in {}".format(pattern, image_dir))
+    groups = []
+    if register:
+        groups = [[keys.index((k, region)) for region in ["l", "c", "r"] if (k, region) in masks] for k in extracted_cells]
+
+    # the output files of each cell, [(path, column name, column of the means or shifts)], started with their header and then
+    # appended to a chunk at a time
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {}
+    for k in extracted_cells:
+        outputs[k] = [(region_path(k, region, output_dir), "Mean", keys.index((k, region))) for region in REGIONS if (k, region) in masks]
+        if register:
+            outputs[k].append((os.path.join(output_dir, "lys_{}_drift.csv".format(str(k).zfill(2))), "Shift", extracted_cells.index(k)))
+        for path, name, column in outputs[k]:
+            pd.DataFrame(columns=["Slice", name]).to_csv(path)
+
+    n_rows = {k: 0 for k in extracted_cells}
+    offset = 0
+    for means, shifts in region_means(paths, [masks[key] for key in keys], chunk_size, threads, groups, max_shift, trench_axis):
+        chunk_timepoints = timepoints[offset:offset + len(means)]
+        offset += len(means)
+        for k in extracted_cells:
+            keep = chunk_timepoints >= first_timepoints.get(k, 0)
+            n = int(keep.sum())
+            if n == 0:
+                continue
+            index = np.arange(n_rows[k], n_rows[k] + n)
+            for path, name, column in outputs[k]:
+                d = pd.DataFrame(index=index)
+                d["Slice"] = index + 1
+                d[name] = (means if name == "Mean" else shifts)[keep, column]
+                d.to_csv(path, mode="a", header=False)
+            n_rows[k] += n
+    return n_rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the region intensity files of the cells of one trench from its image sequence.")
+    parser.add_argument("image_dir", help="directory of the phase contrast image sequence of the trench")
+    parser.add_argument("masks", help="JSON file of the cell masks, {cell: {region: [x, y, width, height] or mask.npy}}")
+    parser.add_argument("--pattern", default=FRAME_PATTERN, help="regular expression of the frame file names, capturing the time point")
+    parser.add_argument("--last-timepoint", type=int, default=None, help="last time point to extract (default: the end of the sequence)")
+    parser.add_argument("--output-dir", default=".", help="directory of the lys_NN_region.csv files")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of frames decoded at a time (default 1000)")
+    parser.add_argument("--threads", type=int, default=8, help="number of decoding threads (default 8)")
+    parser.add_argument("--register", action="store_true", help="move the l, c and r masks with the drift of each cell along the trench")
+    parser.add_argument("--max-shift", type=int, default=20, help="largest drift followed, in pixels (default 20)")
+    parser.add_argument("--vertical", action="store_true", help="the trenches run along the image columns rather than the rows")
+    args = parser.parse_args()
+
+    timepoints, paths = list_frames(args.image_dir, args.pattern)
+    if len(paths) == 0:
+        raise SystemExit("no frames matching {} in {}".format(args.pattern, args.image_dir))
+    masks = load_masks(args.masks, read_frame(paths[0]).shape)
+    # the files of each cell start at its start_timepoint in experiment.py, as the Fiji stacks did
+    first_timepoints = {k: cells[k][1] for k, region in masks if k in cells}
+    n_rows = extract_trench(args.image_dir, masks, first_timepoints, args.pattern, args.last_timepoint, args.output_dir,
+                            args.chunk_size, args.threads, args.register, args.max_shift, 0 if args.vertical else 1)
+    for k in sorted(n_rows):
+        print("cell {}: {} time points".format(k, n_rows[k]))
@@ -0,0 +1,125 @@
+import pandas as pd
+import numpy as np
+import os
+import argparse
+from scipy.signal import find_peaks
+from chunked import CHUNK_SIZE, chunk_bounds
+from lysis_detection import stack_lysis_windows, detect_lysis_batch
+from experiment import cells
+from trace_store import STORE_DIR, load_trace
+
+### Automatic localization of the lysis event in a full trace, in place of (or as a check on) the approximate lysis times found by
+### inspecting the images ('10ms_lysis_times.csv').
+### Coarse search: the trace is reduced to the means of blocks of factor consecutive time points (read a chunk at a time, see
+### chunked.py), and the jumps between consecutive blocks are compared with their typical size (median + n_mad scaled median
+### absolute deviations); the largest jumps, at least min_separation seconds apart, are the candidate events. Lysis adds a large,
+### fast step to the cell intensity, which stands out at this resolution, while noise is averaged down and the scan costs one
+### pass over the trace.
+### Fine search: the +/- 2 second window around every candidate is analysed at full resolution with the Savitzky-Golay derivative
+### method of '06_lysis_detection_all_data.py' (all candidates as one batch). Of the candidates whose lysis start is found, the one
+### with the highest peak rate of intensity change is taken as the lysis event, its peak time serving as the estimated lysis time;
+### the coarse jump only decides between equal peaks, or between the candidates when none of them refines.
+
+def block_means(value_arr, factor=50, chunk_size=CHUNK_SIZE):
+    """
+    return: the means of the consecutive blocks of factor points of value_arr (a final partial block is dropped), computed a
+    chunk of about chunk_size points at a time.
+    """
+    n_blocks = len(value_arr) // factor
+    means = np.empty(n_blocks)
+    blocks_per_chunk = max(1, chunk_size // factor)
+    for lo, hi, core_lo, core_hi in chunk_bounds(n_blocks, blocks_per_chunk):
+        means[lo:hi] = np.asarray(value_arr[lo * factor:hi * factor], dtype=float).reshape(hi - lo, factor).mean(axis=1)
+    return means
+
+def coarse_candidates(time_arr, value_arr, factor=50, n_mad=10, min_separation=10, max_candidates=3):
+    """
+    Finds candidate lysis events in a full trace from the jumps between the means of blocks of factor time points (see the top
+    of this file). Jumps must exceed the median jump by n_mad scaled median absolute deviations, and candidates are at least
+    min_separation seconds apart; at most max_candidates of the largest jumps are kept.
+
+    return: a table of candidates (time, the time between the two blocks, and score, the jump in AU/px), largest jump first.
+    """
+    means = block_means(value_arr, factor)
+    if len(means) < 3:
+        return pd.DataFrame({"time": [], "score": []})
+    jumps = np.diff(means)
+    median = np.median(jumps)
+    mad = 1.4826 * np.median(np.abs(jumps - median))
+    block_time = time_arr[factor] - time_arr[0] # duration of a block
+    distance = max(1, int(round(min_separation / block_time)))
+    peaks, properties = find_peaks(jumps, height=median + n_mad * mad, distance=distance)
+    order = np.argsort(properties["peak_heights"])[::-1][:max_candidates]
+    peaks = peaks[order]
+    return pd.DataFrame({"time": np.asarray(time_arr)[(peaks + 1) * factor], "score": jumps[peaks]})
+
+def localize_lysis(traces, factor=50, n_mad=10, min_separation=10, max_candidates=3, half_width=2, **lysis_params):
+    """
+    Localizes the lysis event of every trace in traces ({cell: trace with "time" and "c" columns}) by the coarse search
+    (coarse_candidates) followed by the fine search of the best candidates with lysis_detection.detect_lysis_batch (lysis_params
+    are passed on to it).
+
+    return: a table with one row per candidate (cell, candidate, coarse_time, score, rise_time, peak_time, peak_value, and best,
+    True for the candidate taken as the lysis event of the cell, see the top of this file).
+    """
+    rows = []
+    windows = {}
+    centres = {}
+    for k, d in traces.items():
+        candidates = coarse_candidates(d["time"], d["c"], factor, n_mad, min_separation, max_candidates)
+        for i, (t, score) in enumerate(zip(candidates["time"], candidates["score"])):
+            windows[(k, i)] = d
+            centres[(k, i)] = t
+            rows.append({"cell": k, "candidate": i, "coarse_time": t, "score": score})
+    candidates = pd.DataFrame(rows, columns=["cell", "candidate", "coarse_time", "score"])
+    for name in ["rise_time", "peak_time", "peak_value"]:
+        candidates[name] = np.nan
+    if windows:
+        keys, time_arr, value_arr, lengths = stack_lysis_windows(windows, centres, half_width=half_width)
+        fast_lysis = detect_lysis_batch(time_arr, value_arr, lengths, **lysis_params)
+        for name in ["rise_time", "peak_time", "peak_value"]:
+            candidates[name] = fast_lysis[name]
+
+    # rank the candidates of each cell by their refined peak (only for those whose rise was found), then by the coarse jump
+    refined_peak = candidates["peak_value"].where(candidates["rise_time"].notna())
+    ranked = candidates.assign(refined_peak=refined_peak).sort_values(["cell", "refined_peak", "score"], ascending=[True, False, False],
+                                                                      na_position="last", kind="stable")
+    candidates["best"] = candidates.index.isin(ranked.groupby("cell").head(1).index)
+    return candidates
+
+def lysis_times_from_candidates(candidates, fallback=None):
+    """
+    return: the estimated lysis time of every cell ({cell: time}), the peak time of its best candidate (or the coarse time if the
+    fine search found no peak). Cells without any candidate take their time from fallback ({cell: time}, e.g. the manual lysis
+    times) if given, and are left out otherwise.
+    """
+    best = candidates[candidates["best"]]
+    lysis_times = dict(fallback or {})
+    lysis_times.update({k: (p if not np.isnan(p) else c) for k, p, c in zip(best["cell"], best["peak_time"], best["coarse_time"])})
+    return lysis_times
+
+def check_lysis_times(automatic, manual, tolerance=1.0):
+    """
+    Compares the automatic lysis times ({cell: time}) with the manual ones (the table '10ms_lysis_times_adjusted.csv').
+
+    return: a table (cell, manual lysis_t, automatic, difference and agrees, True if they are within tolerance seconds).
+    """
+    check = manual[["cell", "lysis_t"]].copy()
+    check["automatic"] = [automatic.get(k, np.nan) for k in check["cell"]]
+    check["difference"] = check["automatic"] - check["lysis_t"]
+    check["agrees"] = check["difference"].abs() <= tolerance
+    return check
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the lysis events automatically and compare them with the manual lysis times.")
+    parser.add_argument("--out", default="dataframes/automatic_lysis_times.csv", help="table of candidate events")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="largest difference from the manual time, in seconds (default 1)")
+    args = parser.parse_args()
+
+    traces = {k: load_trace(k, columns=["time", "c"], store_dir=STORE_DIR) for k in cells}
+    candidates = localize_lysis(traces)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    candidates.to_csv(args.out)
+    check = check_lysis_times(lysis_times_from_candidates(candidates), pd.read_csv("10ms_lysis_times_adjusted.csv"), args.tolerance)
+    print(check.to_string(index=False))
+    print("{} of {} cells agree with the manual lysis times".format(int(check["agrees"].sum()), len(check)))
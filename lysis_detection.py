@@ -0,0 +1,196 @@
+import numpy as np
+from scipy.signal import savgol_filter
+from scipy.signal import find_peaks
+from crossing import find_crossing_points
+from trace_index import time_window_slice
+from profiling import profiled
+from cache import CACHE_DIR, MAX_BYTES, cache_key, array_digest, load_cached, store_cached
+
+### Batched lysis detection (the method developed in '05_lysis_detection_algorithm_testing.py').
+### Rather than filtering and thresholding one cell at a time, the +/- 2 second window around each estimated lysis time is stacked
+### into a single NaN padded 2D array (one row per cell), and the Savitzky-Golay derivative, peak, baseline statistics and the
+### rise and fall threshold crossings are computed for all cells at once.
+### With a cache directory (see cache.py), the filtered derivative and the baseline statistics of each window are cached per row,
+### keyed by the contents of the window and the parameters, so that a window already analysed (by an earlier run, or by another
+### script such as 08) is not filtered again, and only the thresholds are recomputed.
+
+def stack_lysis_windows(traces, lysis_times, half_width=2, column="c"):
+    """
+    Stacks the window [lysis_t - half_width, lysis_t + half_width) of each trace into NaN padded 2D arrays.
+    traces is a dict {cell: table} where each table has a monotonically increasing "time" column and the intensity column to be
+    analysed (column, default "c"), and lysis_times is a dict {cell: estimated lysis time}. Since the time axis is sorted, the window
+    edges are found with a binary search (trace_index.time_window_slice) rather than a boolean mask over the full trace.
+
+    return: cell_ids (list), time_arr and value_arr (2D arrays of shape (n_cells, longest window), padded with NaN) and lengths
+    (the number of valid points in each row).
+    """
+    cell_ids = list(traces.keys())
+    windows = []
+    for k in cell_ids:
+        rows = time_window_slice(traces[k]["time"], lysis_times[k] - half_width, lysis_times[k] + half_width)
+        windows.append((np.asarray(traces[k]["time"][rows], dtype=float), np.asarray(traces[k][column][rows], dtype=float)))
+
+    lengths = np.asarray([len(w[0]) for w in windows], dtype=np.int64)
+    n_cols = int(lengths.max()) if len(lengths) else 0
+    time_arr = np.full((len(cell_ids), n_cols), np.nan)
+    value_arr = np.full((len(cell_ids), n_cols), np.nan)
+    for row, (time, value) in enumerate(windows):
+        time_arr[row, :len(time)] = time
+        value_arr[row, :len(value)] = value
+    return cell_ids, time_arr, value_arr, lengths
+
+@profiled("savgol_filter")
+def savgol_derivative(value_arr, lengths, sg_window=8, sg_order=3):
+    """
+    Computes the derivative of the Savitzky-Golay filtered intensity for each row of a NaN padded 2D array, as
+    np.concatenate(([0], np.diff(savgol_filter(row, sg_window, sg_order)))) would for each unpadded row.
+    The filter is applied along axis 1 in one call per distinct row length (a handful, as the window length only varies with the
+    frame spacing of each trench), so that the polynomial fit at the end of each row matches the unpadded calculation exactly.
+
+    return: dsg, a 2D array of the same shape as value_arr, NaN beyond the valid length of each row.
+    """
+    dsg = np.full(value_arr.shape, np.nan)
+    for n in np.unique(lengths):
+        rows = np.flatnonzero(lengths == n)
+        if n < sg_window:
+            continue
+        sg = savgol_filter(value_arr[rows, :n], sg_window, sg_order, axis=1)
+        dsg[rows, 0] = 0
+        dsg[rows, 1:n] = np.diff(sg, axis=1)
+    return dsg
+
+def cached_savgol_derivative(value_arr, lengths, sg_window=8, sg_order=3, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """
+    savgol_derivative with a cache of the derivative of the whole batch (see cache.py), keyed by the contents of value_arr and
+    lengths and the filter parameters: a rerun on the same windows reads the derivative from the cache instead of filtering.
+
+    return: dsg (as savgol_derivative, as a read-only memory-mapped array) and its cache key.
+    """
+    key = cache_key("savgol_derivative", array_digest(value_arr), array_digest(lengths), sg_window, sg_order)
+    dsg = load_cached(key, cache_dir)
+    if dsg is None:
+        dsg = store_cached(key, savgol_derivative(value_arr, lengths, sg_window, sg_order), cache_dir, max_bytes)
+    return dsg, key
+
+@profiled("find_peaks")
+def find_highest_peaks(value_arr, lengths):
+    """
+    Finds the index of the highest local maximum in each row of a NaN padded 2D array. This is equivalent to
+    find_peaks(row, distance=len(row))[0][0], which the per-cell scripts used to pick out the single largest peak.
+    Rows containing flat peaks (equal neighbouring values) fall back to find_peaks, which places the peak at the plateau centre.
+
+    return: peak_idx, an integer array with the peak index of each row, or -1 if a row has no local maximum.
+    """
+    left = value_arr[:, 1:-1] > value_arr[:, :-2]
+    right = value_arr[:, 1:-1] > value_arr[:, 2:]
+    is_peak = np.zeros(value_arr.shape, dtype=bool)
+    is_peak[:, 1:-1] = left & right
+    heights = np.where(is_peak, value_arr, -np.inf)
+    peak_idx = np.where(is_peak.any(axis=1), np.argmax(heights, axis=1), -1)
+
+    flat = (value_arr[:, 1:] == value_arr[:, :-1]).any(axis=1)
+    for row in np.flatnonzero(flat):
+        n = lengths[row]
+        peaks, properties = find_peaks(value_arr[row, :n], distance=n)
+        peak_idx[row] = peaks[0] if len(peaks) else -1
+    return peak_idx
+
+@profiled("detect_lysis")
+def detect_lysis_batch(time_arr, value_arr, lengths, sg_window=8, sg_order=3, n_std=3, window_length=5, start_offset=60,
+                       baseline_start=1.5, baseline_end=0.5, fall_fraction=0.5, cache_dir=None):
+    """
+    Applies the lysis detection algorithm to every row of the NaN padded arrays returned by stack_lysis_windows.
+    For each row: the derivative of the Savitzky-Golay filtered intensity is found (sg_window points, polynomial order sg_order),
+    its maximum gives the peak, the mean and standard deviation of the derivative between baseline_start and baseline_end seconds
+    before the peak set the rise threshold (mean + n_std standard deviations), and the rise is the first crossing of that threshold for
+    window_length consecutive points, searching from start_offset points before the peak. The fall is the first point after the
+    peak at which the derivative stays below fall_fraction of its maximum for window_length consecutive points.
+    If cache_dir is given, the derivative and window statistics of the batch are cached there (see cached_savgol_derivative).
+
+    return: a dict of arrays with one entry per row: rise_idx, rise_time (t5 in the paper), peak_idx, peak_time, peak_value (the
+    maximal rate of intensity change), fall_idx, fall_time, mu and std. Indices refer to the window and are -1 (times NaN) where no crossing or peak was found.
+    """
+    stats = None
+    if cache_dir is None:
+        dsg = savgol_derivative(value_arr, lengths, sg_window, sg_order)
+    else:
+        dsg, key = cached_savgol_derivative(value_arr, lengths, sg_window, sg_order, cache_dir)
+        stats = cached_lysis_window_stats(time_arr, dsg, lengths, key, baseline_start, baseline_end, cache_dir)
+    return detect_lysis_from_derivative(time_arr, dsg, lengths, n_std=n_std, window_length=window_length, start_offset=start_offset,
+                                        baseline_start=baseline_start, baseline_end=baseline_end, fall_fraction=fall_fraction, stats=stats)
+
+def lysis_window_stats(time_arr, dsg, lengths, baseline_start=1.5, baseline_end=0.5):
+    """
+    Finds the peak of the derivative dsg in every row, and the mean and standard deviation of the derivative between
+    baseline_start and baseline_end seconds before the peak.
+
+    return: a dict of arrays with one entry per row: peak_idx (-1 if there is no peak), peak_time, peak_value, mu and std.
+    """
+    n_traces = time_arr.shape[0]
+    rows = np.arange(n_traces)
+    peak_idx = find_highest_peaks(dsg, lengths)
+    has_peak = peak_idx >= 0
+    peak_time = np.where(has_peak, time_arr[rows, np.clip(peak_idx, 0, None)], np.nan)
+    peak_value = np.where(has_peak, dsg[rows, np.clip(peak_idx, 0, None)], np.nan)
+
+    # baseline statistics of the derivative between baseline_start and baseline_end seconds before the peak
+    tp_0 = peak_time - baseline_start
+    tp_1 = peak_time - baseline_end
+    with np.errstate(invalid="ignore"):
+        in_baseline = (time_arr >= tp_0[:, np.newaxis]) & (time_arr < tp_1[:, np.newaxis])
+    n_baseline = in_baseline.sum(axis=1)
+    baseline = np.where(in_baseline, dsg, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mu = baseline.sum(axis=1) / n_baseline
+        std = np.sqrt(np.where(in_baseline, (dsg - mu[:, np.newaxis]) ** 2, 0).sum(axis=1) / (n_baseline - 1))
+    return {"peak_idx": peak_idx, "peak_time": peak_time, "peak_value": peak_value, "mu": mu, "std": std}
+
+def cached_lysis_window_stats(time_arr, dsg, lengths, key, baseline_start=1.5, baseline_end=0.5, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """
+    lysis_window_stats with a cache of the statistics of the whole batch (see cache.py), keyed by the cache key of dsg (as
+    returned by cached_savgol_derivative), the time axes of the windows and the baseline.
+
+    return: the same dict of arrays as lysis_window_stats.
+    """
+    names = ["peak_idx", "peak_time", "peak_value", "mu", "std"]
+    key = cache_key("lysis_window_stats", key, array_digest(time_arr), baseline_start, baseline_end)
+    values = load_cached(key, cache_dir)
+    if values is None:
+        stats = lysis_window_stats(time_arr, dsg, lengths, baseline_start, baseline_end)
+        values = store_cached(key, np.column_stack([stats[name] for name in names]), cache_dir, max_bytes)
+    stats = {name: np.array(values[:, i]) for i, name in enumerate(names)}
+    stats["peak_idx"] = stats["peak_idx"].astype(np.int64)
+    return stats
+
+def detect_lysis_from_derivative(time_arr, dsg, lengths, n_std=3, window_length=5, start_offset=60, baseline_start=1.5, baseline_end=0.5,
+                                 fall_fraction=0.5, stats=None):
+    """
+    The thresholding part of detect_lysis_batch, starting from an already filtered derivative dsg (as returned by savgol_derivative),
+    so that the derivative can be reused when only the threshold parameters change. stats are the window statistics of dsg (as
+    returned by lysis_window_stats for baseline_start and baseline_end), which are computed if not given.
+
+    return: the same dict of arrays as detect_lysis_batch.
+    """
+    if stats is None:
+        stats = lysis_window_stats(time_arr, dsg, lengths, baseline_start, baseline_end)
+    peak_idx, peak_time, peak_value, mu, std = (stats[name] for name in ["peak_idx", "peak_time", "peak_value", "mu", "std"])
+    has_peak = peak_idx >= 0
+    rows = np.arange(time_arr.shape[0])
+
+    rise_idx = find_crossing_points(dsg, mu + n_std * std, window_length, start_idx=peak_idx - start_offset, mode="increasing")
+    fall_idx = find_crossing_points(dsg, peak_value * fall_fraction, window_length, start_idx=peak_idx, mode="decreasing")
+    rise_idx[~has_peak] = -1
+    fall_idx[~has_peak] = -1
+
+    def lookup_time(idx):
+        return np.where(idx >= 0, time_arr[rows, np.clip(idx, 0, None)], np.nan)
+
+    return {"rise_idx": rise_idx,
+            "rise_time": lookup_time(rise_idx),
+            "peak_idx": peak_idx,
+            "peak_time": peak_time,
+            "peak_value": peak_value,
+            "fall_idx": fall_idx,
+            "fall_time": lookup_time(fall_idx),
+            "mu": mu,
+            "std": std}
@@ -0,0 +1,86 @@
+import numpy as np
+from chunked import chunked_crossing_point
+from trace_index import timepoint_to_index
+from profiling import profiled
+
+### Perforation detection (the method developed in '07_perforation_detection_algorithm_testing.py').
+### The mean and standard deviation of the phase contrast intensity over a 200 time point baseline window, starting a set number of
+### time points before the peak rate of intensity change, give a threshold (mean + 3 standard deviations), and the perforation start
+### (t4 in the paper) is the first time the intensity stays above it for 5 consecutive time points.
+### The baseline window can also be chosen automatically (find_baseline_window) as the most stationary window shortly before the event.
+
+def baseline_start_index(timepoint_arr, peak_idx, offset):
+    """
+    Finds the index of the start of the baseline window, offset time points before the peak at index peak_idx.
+
+    return: the index of the time point timepoint_arr[peak_idx] - offset.
+    """
+    return timepoint_to_index(timepoint_arr, int(timepoint_arr[peak_idx]) - offset)
+
+@profiled("detect_perforation")
+def detect_perforation(time_arr, value_arr, start_idx, baseline_length=200, n_std=3, window_length=5):
+    """
+    Applies the perforation detection algorithm to one trace. The baseline is value_arr[start_idx:start_idx+baseline_length],
+    and the search for the threshold crossing also starts at start_idx.
+
+    return: rise_idx and rise (the index and time of the perforation start, t4 in the paper; -1 and NaN if the threshold is never
+    crossed), and the baseline mean and standard deviation mu and std.
+    """
+    value_arr = np.asarray(value_arr)
+    mu = np.mean(value_arr[start_idx:start_idx+baseline_length])
+    std = np.std(value_arr[start_idx:start_idx+baseline_length], ddof=1)
+
+    # the trace is searched in chunks from start_idx, so a long (memory-mapped) trace is only read up to the crossing
+    threshold_value = mu + n_std*std
+    rise_idx = chunked_crossing_point(value_arr, threshold_value, window_length, start_idx=start_idx, mode="increasing")
+    if rise_idx < 0:
+        return -1, np.nan, mu, std
+    return rise_idx, time_arr[rise_idx], mu, std
+
+def rolling_window_stats(value_arr, window_length):
+    """
+    Computes, for every window value_arr[i:i+window_length], its mean, standard deviation (ddof=1) and drift (the mean of the second
+    half of the window minus the mean of the first half). All windows are evaluated in O(n) from cumulative sums of the values and
+    of their squares, rather than O(n * window_length) by recomputing each window. The values are centred on their overall mean
+    first, which keeps the cumulative sum of squares from losing precision on long traces.
+
+    return: mean, std and drift, 1D arrays of length len(value_arr) - window_length + 1.
+    """
+    value_arr = np.asarray(value_arr, dtype=float)
+    offset = np.mean(value_arr)
+    x = value_arr - offset
+    s1 = np.concatenate(([0], np.cumsum(x)))
+    s2 = np.concatenate(([0], np.cumsum(x * x)))
+    w = window_length
+    h = w // 2
+
+    sum1 = s1[w:] - s1[:-w]
+    sum2 = s2[w:] - s2[:-w]
+    mean = sum1 / w
+    var = np.clip((sum2 - sum1 * mean) / (w - 1), 0, None)
+    first_half = (s1[h:len(s1) - w + h] - s1[:-w]) / h
+    second_half = (s1[w:] - s1[h:len(s1) - w + h]) / (w - h)
+    return mean + offset, np.sqrt(var), second_half - first_half
+
+@profiled("find_baseline_window")
+def find_baseline_window(value_arr, peak_idx, baseline_length=200, min_offset=800, max_offset=3000, tolerance=0.05):
+    """
+    Automatically chooses the baseline window for perforation detection, in place of the hand-tuned start_adjust.
+    Every window of baseline_length points starting between max_offset and min_offset points before the peak (default 800 to 3000,
+    the range covered by the hand-tuned offsets) is scored by its standard deviation plus the absolute value of its drift, so that
+    windows that are noisy or contain a trend (such as a cell moving under the mask, or the start of perforation) score badly.
+    Of the windows scoring within a fraction tolerance of the best score, the one closest to the event is chosen.
+
+    return: start_idx (the index of the start of the chosen window), offset (how many points before the peak it starts), and
+    its score, mean and standard deviation.
+    """
+    lo = max(0, peak_idx - max_offset)
+    hi = peak_idx - min_offset
+    if hi < lo:
+        raise ValueError("no baseline window fits between {} and {} points before the peak at index {}".format(max_offset, min_offset, peak_idx))
+    mean, std, drift = rolling_window_stats(np.asarray(value_arr)[lo:hi+baseline_length], baseline_length)
+    score = std + np.abs(drift)
+    acceptable = np.flatnonzero(score <= score.min() * (1 + tolerance))
+    best = acceptable[-1] # the latest acceptable window, i.e. the closest to the event
+    start_idx = lo + int(best)
+    return start_idx, peak_idx - start_idx, score[best], mean[best], std[best]
@@ -0,0 +1,235 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import hashlib
+import argparse
+import profiling
+import experiment
+from collate import REGIONS, region_path, collate_cells, adjust_lysis_times
+from lysis_detection import stack_lysis_windows, detect_lysis_batch
+from perforation_detection import baseline_start_index, detect_perforation, find_baseline_window
+from trace_store import STORE_DIR, trace_path, load_trace, load_trace_info
+from trace_index import nearest_index
+from profiling import profiled
+from results import RESULTS_DB, connect, run_params, upsert_results
+
+### A pipeline runner for the analysis in scripts 01, 04, 06 and 08, with incremental recomputation.
+### The stages form a small dependency graph (see DEPENDENCIES): collating the region files (01) and adjusting the approximate
+### lysis times (04) are independent, lysis detection (06) needs both, and perforation detection (08) needs the collated traces and
+### the lysis detection. For every stage and every cell a fingerprint of its inputs and parameters is computed, combining the
+### fingerprints of the upstream stages, and compared with the manifest saved by the previous run ('.pipeline/manifest.json').
+### Only the cells whose fingerprint changed are recomputed; the results of the others are taken from the manifest. All stages run
+### in one process, so the traces and detection results are passed between stages in memory rather than reread from the csv files.
+### The usual output tables are written at the end of every run:
+### '10ms_lysis_times_adjusted.csv', 'dataframes/cell_envelope_breakdown_analysis.csv' and 'dataframes/perforation_analysis.csv'.
+
+MANIFEST = os.path.join(".pipeline", "manifest.json")
+MANIFEST_VERSION = 2 # increase whenever the layout of the stored results changes, so that older manifests are discarded
+
+STAGES = ["collate", "adjust_times", "detect_lysis", "detect_perforation"]
+DEPENDENCIES = {"collate": [],
+                "adjust_times": [],
+                "detect_lysis": ["collate", "adjust_times"],
+                "detect_perforation": ["collate", "detect_lysis"]}
+
+# default detection parameters, as used in '06_lysis_detection_all_data.py' and '08_perforation_detection_all_data.py'
+LYSIS_PARAMS = {"half_width": 2, "sg_window": 8, "sg_order": 3, "n_std": 3, "window_length": 5, "start_offset": 60}
+PERFORATION_PARAMS = {"baseline_length": 200, "n_std": 3, "window_length": 5}
+
+def fingerprint(*parts):
+    """
+    return: a short hash of parts, which must be JSON serialisable.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:16]
+
+def file_fingerprint(path):
+    """
+    return: a hash of the path, size and modification time of a file (the contents are not read).
+    """
+    stat = os.stat(path)
+    return fingerprint(path, stat.st_size, stat.st_mtime_ns)
+
+def load_manifest(path=MANIFEST):
+    """
+    return: the manifest of the previous run, {stage: {cell: {"fingerprint": ..., "result": ...}}}, or an empty one if there is
+    none or it was written with a different MANIFEST_VERSION.
+    """
+    manifest = {stage: {} for stage in STAGES}
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved.get("version") != MANIFEST_VERSION:
+            return manifest
+        for stage in STAGES:
+            manifest[stage] = {int(k): v for k, v in saved.get(stage, {}).items()}
+    return manifest
+
+def save_manifest(manifest, path=MANIFEST):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        saved = {stage: {str(k): v for k, v in entries.items()} for stage, entries in manifest.items()}
+        saved["version"] = MANIFEST_VERSION
+        json.dump(saved, f)
+    os.replace(path + ".tmp", path)
+
+def stale_cells(manifest, stage, fingerprints):
+    """
+    return: the cells of fingerprints ({cell: fingerprint}) whose fingerprint differs from the one recorded for stage in the manifest.
+    """
+    return [k for k, fp in fingerprints.items() if manifest[stage].get(k, {}).get("fingerprint") != fp]
+
+def run_pipeline(cells=None, lysis_params=None, perforation_params=None, auto_baseline=False, jobs=1, force=False, input_dir=".",
+                 store_dir=STORE_DIR, manifest_path=MANIFEST, results_path=RESULTS_DB, verbose=True):
+    """
+    Runs the collate, adjust_times, detect_lysis and detect_perforation stages, recomputing only the cells whose inputs or
+    parameters changed since the last run (or every cell if force is True). cells defaults to experiment.cells, and the
+    inclusion lists, baseline offsets and frame spacings are taken from experiment.py. lysis_params and perforation_params
+    override entries of LYSIS_PARAMS and PERFORATION_PARAMS. With auto_baseline=True the perforation baseline window of each cell is
+    chosen by perforation_detection.find_baseline_window instead of the hand-tuned start_adjust. jobs sets the number of worker
+    processes used for collation. The detection results are also stored in the results database at results_path (see results.py),
+    unless it is None.
+
+    return: a dict {stage: list of recomputed cells}.
+    """
+    if cells is None:
+        cells = experiment.cells
+    lysis_params = dict(LYSIS_PARAMS, **(lysis_params or {}))
+    perforation_params = dict(PERFORATION_PARAMS, **(perforation_params or {}))
+    frame_spacing = experiment.frame_spacing
+    metadata_files = experiment.metadata_files
+    # trenches timed by their metadata file depend on it as well as on the frame spacing
+    timing = {v[0]: file_fingerprint(metadata_files[v[0]]) if v[0] in metadata_files else None for v in cells.values()}
+    manifest = {stage: {} for stage in STAGES} if force else load_manifest(manifest_path)
+    recomputed = {}
+    fps = {}
+
+    # 01: collate the region files. The fingerprint covers the four input files and the time adjustment of the cell.
+    fps["collate"] = {}
+    for k, v in cells.items():
+        inputs = [file_fingerprint(region_path(k, region, input_dir)) for region in REGIONS]
+        fps["collate"][k] = fingerprint(inputs, v, frame_spacing[v[0] - 1], timing[v[0]])
+    # cells missing from the store (e.g. deleted by hand) are collated again even if their inputs are unchanged
+    stale = set(stale_cells(manifest, "collate", fps["collate"]))
+    todo = [k for k in cells if k in stale or not os.path.isdir(trace_path(k, store_dir))]
+    if todo:
+        n_rows = collate_cells({k: cells[k] for k in todo}, frame_spacing, jobs=jobs, input_dir=input_dir, store_dir=store_dir,
+                               metadata_files=metadata_files)
+        for k in todo:
+            manifest["collate"][k] = {"fingerprint": fps["collate"][k], "result": n_rows[k]}
+    recomputed["collate"] = todo
+
+    # 04: adjust the approximate lysis times. The fingerprint covers the table entry and the frame spacing of the cell.
+    lysis_times = pd.read_csv(os.path.join(input_dir, "10ms_lysis_times.csv"))
+    lysis_times = lysis_times[lysis_times["cell"].isin(cells.keys())]
+    lysis_t_start = dict(zip(lysis_times["cell"].tolist(), lysis_times["lysis_t_start"].tolist()))
+    fps["adjust_times"] = {k: fingerprint(lysis_t_start[k], frame_spacing[cells[k][0] - 1], timing[cells[k][0]]) for k in lysis_t_start}
+    todo = stale_cells(manifest, "adjust_times", fps["adjust_times"])
+    if todo:
+        adjusted = adjust_lysis_times(lysis_times[lysis_times["cell"].isin(todo)], cells, frame_spacing, metadata_files)
+        for k, t in zip(adjusted["cell"].tolist(), adjusted["lysis_t"].tolist()):
+            manifest["adjust_times"][k] = {"fingerprint": fps["adjust_times"][k], "result": t}
+    recomputed["adjust_times"] = todo
+
+    # 06: lysis detection, for the events included in the lysis analysis and those included for perforation only
+    # (whose lysis start is needed as the end of perforation). The stale cells are detected together in one batch.
+    lysis_cells = [k for k in cells if k in experiment.clean + experiment.fast_lysis_only + experiment.slow_only]
+    # the fingerprint includes the view of the trace (see '03_trim_oversized_data.py'), which is not part of the collated data
+    views = {k: load_trace_info(k, store_dir).get("view") for k in lysis_cells}
+    fps["detect_lysis"] = {k: fingerprint(fps["collate"][k], fps["adjust_times"][k], lysis_params, views[k]) for k in lysis_cells}
+    todo = stale_cells(manifest, "detect_lysis", fps["detect_lysis"])
+    traces = {}
+    if todo:
+        for k in todo:
+            traces[k] = load_trace(k, columns=["timepoint", "time", "c"], store_dir=store_dir)
+        lys_ts = {k: manifest["adjust_times"][k]["result"] for k in todo}
+        cell_ids, time_arr, value_arr, lengths = stack_lysis_windows(traces, lys_ts, half_width=lysis_params["half_width"])
+        batch_params = {name: value for name, value in lysis_params.items() if name != "half_width"}
+        fast_lysis = detect_lysis_batch(time_arr, value_arr, lengths, **batch_params)
+        for i, k in enumerate(cell_ids):
+            result = {name: float(fast_lysis[name][i]) for name in ["rise_time", "peak_time", "fall_time"]}
+            manifest["detect_lysis"][k] = {"fingerprint": fps["detect_lysis"][k], "result": result}
+    recomputed["detect_lysis"] = todo
+
+    # 08: perforation detection, with the baseline window placed relative to the peak found by the lysis detection,
+    # either at the hand-tuned offset or at the automatically chosen one
+    perforation_cells = [k for k in cells if k in experiment.clean + experiment.slow_only]
+    if auto_baseline:
+        offsets = {k: "auto" for k in perforation_cells}
+    else:
+        offsets = {k: experiment.baseline_offset + experiment.start_adjust.get(k, 0) for k in perforation_cells}
+    fps["detect_perforation"] = {k: fingerprint(fps["collate"][k], fps["detect_lysis"][k], offsets[k], perforation_params)
+                                 for k in perforation_cells}
+    todo = stale_cells(manifest, "detect_perforation", fps["detect_perforation"])
+    for k in todo:
+        if k not in traces:
+            traces[k] = load_trace(k, columns=["timepoint", "time", "c"], store_dir=store_dir)
+        d = traces[k]
+        peak_idx = nearest_index(d["time"], manifest["detect_lysis"][k]["result"]["peak_time"])
+        if auto_baseline:
+            start_idx, offset, score, mu, std = find_baseline_window(d["c"], peak_idx, baseline_length=perforation_params["baseline_length"])
+        else:
+            offset = offsets[k]
+            start_idx = baseline_start_index(d["timepoint"], peak_idx, offset)
+        rise_idx, rise, mu, std = detect_perforation(d["time"], d["c"], start_idx, **perforation_params)
+        result = {"start_time": float(rise), "baseline_offset": int(offset)}
+        manifest["detect_perforation"][k] = {"fingerprint": fps["detect_perforation"][k], "result": result}
+    recomputed["detect_perforation"] = todo
+
+    save_manifest(manifest, manifest_path)
+    outputs = write_outputs(manifest, cells, lysis_times, lysis_cells=[k for k in cells if k in experiment.clean + experiment.fast_lysis_only],
+                            perforation_cells=perforation_cells, report_baseline=auto_baseline)
+    if verbose:
+        for stage in STAGES:
+            print("{}: {} recomputed, {} up to date".format(stage, len(recomputed[stage]), len(fps[stage]) - len(recomputed[stage])))
+    if results_path:
+        conn = connect(results_path)
+        params = run_params(lysis_params, perforation_params, auto_baseline)
+        for table, results in outputs.items():
+            n = upsert_results(conn, table, experiment.experiment_id, cells, results, params[table])
+            if verbose:
+                print("results database: {} {} rows changed".format(n, table))
+        conn.close()
+    return recomputed
+
+@profiled("write_outputs")
+def write_outputs(manifest, cells, lysis_times, lysis_cells, perforation_cells, report_baseline=False):
+    """
+    Writes the tables produced by scripts 04, 06 and 08 from the results held in the manifest. If report_baseline is True, the
+    offset of the perforation baseline window of each cell is added to 'perforation_analysis.csv' as a baseline_offset column.
+
+    return: the two detection tables, {"lysis": cell_envelope_breakdown_analysis, "perforation": perforation_analysis}.
+    """
+    lysis_times_adjusted = lysis_times.copy()
+    lysis_times_adjusted["lysis_t"] = [manifest["adjust_times"][k]["result"] for k in lysis_times_adjusted["cell"]]
+    lysis_times_adjusted.to_csv("10ms_lysis_times_adjusted.csv")
+
+    os.makedirs("dataframes", exist_ok=True)
+    cell_envelope_breakdown_analysis = pd.DataFrame()
+    cell_envelope_breakdown_analysis["cell"] = lysis_cells
+    for name in ["rise_time", "peak_time", "fall_time"]:
+        cell_envelope_breakdown_analysis[name] = [manifest["detect_lysis"][k]["result"][name] for k in lysis_cells]
+    cell_envelope_breakdown_analysis.to_csv("dataframes/cell_envelope_breakdown_analysis.csv")
+
+    df = pd.DataFrame()
+    df["cell"] = sorted(perforation_cells)
+    df["start_time"] = [manifest["detect_perforation"][k]["result"]["start_time"] for k in df["cell"]]
+    df["end_time"] = [manifest["detect_lysis"][k]["result"]["rise_time"] for k in df["cell"]]
+    df["perforation_duration"] = df["end_time"] - df["start_time"]
+    if report_baseline:
+        df["baseline_offset"] = [manifest["detect_perforation"][k]["result"]["baseline_offset"] for k in df["cell"]]
+    df.to_csv("dataframes/perforation_analysis.csv")
+    return {"lysis": cell_envelope_breakdown_analysis, "perforation": df}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the collate, time adjustment, lysis and perforation detection stages incrementally.")
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes for collation (default 1)")
+    parser.add_argument("--force", action="store_true", help="ignore the manifest and recompute every stage for every cell")
+    parser.add_argument("--auto-baseline", action="store_true", help="choose the perforation baseline windows automatically")
+    parser.add_argument("--results", default=RESULTS_DB, help="results database (default {})".format(RESULTS_DB))
+    parser.add_argument("--no-results", action="store_true", help="do not store the results in the results database")
+    parser.add_argument("--profile", nargs="?", const="profile", metavar="DIR", help="record a profile of the run in DIR (default profile)")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile)
+    run_pipeline(auto_baseline=args.auto_baseline, jobs=args.jobs, force=args.force, results_path=None if args.no_results else args.results)
@@ -0,0 +1,109 @@
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from chunked import CHUNK_SIZE
+from trace_store import STORE_DIR, COLUMNS, trace_path, load_trace
+from profiling import profiled
+
+### Batch rendering of the time series plots (see '02_plot_time_series.py').
+### Figures are drawn with the non-interactive Agg backend on a pool of worker processes. Each trace is min/max decimated before
+### drawing: the points are split into bins and only the minimum and maximum of each bin are plotted, which keeps every peak and
+### dip visible at the output resolution while drawing a few thousand points instead of the full trace. A plot is skipped if it is
+### newer than the stored data it was drawn from.
+
+PLOT_DIR = "time_series_plots"
+
+# region column: label
+REGION_LABELS = {"l": "Left of cell",
+                 "c": "Cell",
+                 "r": "Right of cell",
+                 "st": "Side trench"}
+
+def minmax_decimate(x, y, n_bins=2000):
+    """
+    Reduces the series (x, y) to at most 2 * n_bins + 2 points, keeping the minimum and maximum of y in each of n_bins bins of
+    consecutive points, in their original order. Series that are already short enough are returned unchanged.
+
+    return: the decimated x and y arrays.
+    """
+    x = np.asarray(x) # no copy is made of memory-mapped arrays
+    y = np.asarray(y)
+    n = len(y)
+    if n <= 2 * n_bins:
+        return x, y
+    bin_size = n // n_bins
+    # the bins are reduced a block at a time, so that a long memory-mapped trace is never read into memory as a whole
+    bins_per_block = max(1, CHUNK_SIZE // bin_size)
+    idx = []
+    for b0 in range(0, n_bins, bins_per_block):
+        b1 = min(b0 + bins_per_block, n_bins)
+        binned = np.asarray(y[b0 * bin_size:b1 * bin_size]).reshape(b1 - b0, bin_size)
+        offsets = np.arange(b0, b1) * bin_size
+        idx.extend([offsets + np.argmin(binned, axis=1), offsets + np.argmax(binned, axis=1)])
+    if bin_size * n_bins < n:
+        tail = y[bin_size * n_bins:]
+        idx.append(np.asarray([bin_size * n_bins + np.argmin(tail), bin_size * n_bins + np.argmax(tail)]))
+    idx = np.unique(np.concatenate(idx))
+    return x[idx], y[idx]
+
+def plot_path(cell, plot_dir=PLOT_DIR, prefix=None):
+    """
+    return: the path of the full time series plot of cell, with the file name prefixed by prefix (e.g. the date of the experiment,
+    see experiment.py) if given.
+    """
+    name = "lysis_{}_full_time_series.png".format(str(cell).zfill(2))
+    return os.path.join(plot_dir, "{}_{}".format(prefix, name) if prefix else name)
+
+def is_up_to_date(cell, out_path, store_dir=STORE_DIR):
+    """
+    return: True if the plot out_path exists and is newer than every stored column of cell.
+    """
+    if not os.path.exists(out_path):
+        return False
+    source = trace_path(cell, store_dir)
+    if os.path.isdir(source):
+        sources = [os.path.join(source, name + ".npy") for name in COLUMNS] + [os.path.join(source, "meta.json")] # includes the view
+    else:
+        sources = [source + ".csv"]
+    return os.path.getmtime(out_path) >= max(os.path.getmtime(path) for path in sources)
+
+@profiled("render_plot", cell_arg="cell")
+def render_time_series(cell, out_path, store_dir=STORE_DIR, n_bins=2000, dpi=300):
+    """
+    Draws the l, c, r and st intensities of one cell against time (decimated with minmax_decimate) and saves the figure to out_path.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    d = load_trace(cell, store_dir=store_dir)
+    plt.subplots(nrows=1, ncols=1, figsize=(12,8))
+    for region, label in REGION_LABELS.items():
+        x, y = minmax_decimate(d["time"], d[region], n_bins)
+        plt.plot(x, y, label="{}, {}".format(label, str(cell).zfill(2)))
+    plt.xlabel("Time (s)", fontsize=18)
+    plt.ylabel("Mean intensity (AU/px)", fontsize=18)
+    plt.legend(fontsize=16)
+    plt.xticks(fontsize=16)
+    plt.yticks(fontsize=16)
+    plt.savefig(out_path, bbox_inches='tight', dpi=dpi)
+    plt.close()
+    return cell
+
+def _render_star(args):
+    return render_time_series(*args)
+
+def render_all(cells, jobs=1, force=False, plot_dir=PLOT_DIR, store_dir=STORE_DIR, n_bins=2000, dpi=300, prefix=None):
+    """
+    Renders the time series plot of every cell in cells on a pool of jobs worker processes, skipping plots that are newer than
+    their data unless force is True. prefix is the prefix of the file names (see plot_path).
+
+    return: the list of cells whose plots were rendered.
+    """
+    os.makedirs(plot_dir, exist_ok=True)
+    tasks = [(k, plot_path(k, plot_dir, prefix), store_dir, n_bins, dpi) for k in cells
+             if force or not is_up_to_date(k, plot_path(k, plot_dir, prefix), store_dir)]
+    if jobs <= 1:
+        return [_render_star(t) for t in tasks]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_render_star, tasks))
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import atexit
+import functools
+import inspect
+import tracemalloc
+
+### Instrumentation of the hot paths of the analysis (csv parsing, trace loading and saving, Savitzky-Golay filtering, peak
+### finding, threshold crossings, plotting and writing tables), for finding where the time goes in a full run.
+### Profiling is off unless the environment variable LYSIS_PROFILE is set to an output directory (or to 1, for 'profile'), or a
+### script is run with --profile. Each instrumented operation is a stage, recorded with its wall time, the bytes read from disk
+### (from /proc/self/io where available, plus the bytes of memory-mapped arrays handed out by the trace store), the peak memory
+### allocated during the stage (traced with tracemalloc) and the cell it was working on (inherited from the enclosing stage if not
+### given). Stages may be nested. Worker processes inherit the setting and write their own records, and the process that switched
+### profiling on collects them at exit into 'trace.json' and 'trace.csv' (one record per stage call) and 'summary.csv' (totals
+### per stage), and prints the summary. When profiling is off, an instrumented call costs a single flag check.
+### pandas is only imported to write the report, so that importing this module (which nearly every module does) stays cheap.
+
+ENV_VAR = "LYSIS_PROFILE"
+DEFAULT_DIR = "profile"
+
+_stack = [] # the open stages of this process
+_records = [] # records not yet written to this process's trace file
+_state = {"enabled": False, "out_dir": None}
+
+def enabled():
+    return _state["enabled"]
+
+def enable(out_dir=DEFAULT_DIR):
+    """
+    Switches profiling on for this process and for the worker processes it starts, writing the report to out_dir at exit.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(out_dir):
+        if name.startswith("trace_") and name.endswith(".jsonl"):
+            os.remove(os.path.join(out_dir, name))
+    os.environ[ENV_VAR] = out_dir
+    os.environ[ENV_VAR + "_OWNER"] = str(os.getpid())
+    _start(out_dir)
+    atexit.register(report)
+
+def _start(out_dir):
+    _state["enabled"] = True
+    _state["out_dir"] = out_dir
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def _bytes_read():
+    # characters read by this process so far (Linux only)
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+class stage:
+    """
+    A context manager recording one call of the stage name (for cell, if given; otherwise the cell of the enclosing stage).
+    """
+    def __init__(self, name, cell=None):
+        self.name = name
+        self.cell = cell
+
+    def __enter__(self):
+        if not _state["enabled"]:
+            return self
+        if self.cell is None and _stack:
+            self.cell = _stack[-1].cell
+        _fold_peak()
+        self.peak = 0
+        self.extra_bytes = 0
+        self.start_bytes = _bytes_read()
+        self.start = time.perf_counter()
+        _stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        if not _state["enabled"] or not _stack or _stack[-1] is not self:
+            return False
+        wall = time.perf_counter() - self.start
+        _fold_peak()
+        _stack.pop()
+        bytes_read = _bytes_read() - self.start_bytes + self.extra_bytes
+        if _stack:
+            _stack[-1].extra_bytes += self.extra_bytes
+        cell = None if self.cell is None else int(self.cell)
+        _records.append({"pid": os.getpid(), "stage": self.name, "cell": cell, "depth": len(_stack),
+                         "start": time.time() - wall, "wall": wall, "bytes_read": bytes_read, "peak_memory": self.peak})
+        if not _stack:
+            _flush()
+        return False
+
+def _fold_peak():
+    # fold the traced peak since the last reset into every open stage, then start a new peak measurement
+    peak = tracemalloc.get_traced_memory()[1]
+    for s in _stack:
+        s.peak = max(s.peak, peak)
+    tracemalloc.reset_peak()
+
+def add_bytes_read(n):
+    """
+    Adds n bytes to the bytes read by the current stage, for reads that /proc/self/io does not see (memory-mapped files).
+    """
+    if _state["enabled"] and _stack:
+        _stack[-1].extra_bytes += int(n)
+
+def profiled(name, cell_arg=None):
+    """
+    A decorator recording every call of the decorated function as the stage name. If cell_arg is the name of an argument of
+    the function, its value is recorded as the cell.
+    """
+    def decorator(func):
+        position = list(inspect.signature(func).parameters).index(cell_arg) if cell_arg else None
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state["enabled"]:
+                return func(*args, **kwargs)
+            cell = None
+            if cell_arg:
+                cell = kwargs[cell_arg] if cell_arg in kwargs else args[position] if position < len(args) else None
+            with stage(name, cell):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _after_fork():
+    # a forked worker starts with no open stages of its own (and must not write the parent's records)
+    del _stack[:]
+    del _records[:]
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def _flush():
+    if not _records:
+        return
+    with open(os.path.join(_state["out_dir"], "trace_{}.jsonl".format(os.getpid())), "a") as f:
+        for record in _records:
+            f.write(json.dumps(record) + "\n")
+    del _records[:]
+
+def load_trace_records(out_dir=DEFAULT_DIR):
+    """
+    return: a table of every stage call recorded in out_dir, in order of start time.
+    """
+    import pandas as pd
+    records = []
+    for name in sorted(os.listdir(out_dir)):
+        if name.startswith("trace_") and name.endswith(".jsonl"):
+            with open(os.path.join(out_dir, name)) as f:
+                records.extend(json.loads(line) for line in f)
+    columns = ["pid", "stage", "cell", "depth", "start", "wall", "bytes_read", "peak_memory"]
+    return pd.DataFrame(records, columns=columns).sort_values("start", kind="stable").reset_index(drop=True)
+
+def summarise(trace):
+    """
+    return: a table with one row per stage: the number of calls, the total, mean and maximum wall time in seconds, the total bytes
+    read and the largest peak memory, sorted by total wall time.
+    """
+    summary = trace.groupby("stage").agg(calls=("wall", "size"), total_wall=("wall", "sum"), mean_wall=("wall", "mean"),
+                                         max_wall=("wall", "max"), bytes_read=("bytes_read", "sum"), peak_memory=("peak_memory", "max"))
+    return summary.sort_values("total_wall", ascending=False)
+
+def report(out_dir=None):
+    """
+    Writes 'trace.json', 'trace.csv' and 'summary.csv' to the profiling output directory and prints the summary.
+    """
+    out_dir = out_dir or _state["out_dir"]
+    _flush()
+    trace = load_trace_records(out_dir)
+    if trace.empty:
+        return
+    trace.to_csv(os.path.join(out_dir, "trace.csv"), index=False)
+    with open(os.path.join(out_dir, "trace.json"), "w") as f:
+        json.dump(json.loads(trace.to_json(orient="records")), f, indent=1)
+    summary = summarise(trace)
+    summary.to_csv(os.path.join(out_dir, "summary.csv"))
+    import pandas as pd
+    with pd.option_context("display.width", 200, "display.max_columns", 10):
+        print("Profile ({} stage calls, written to {}):".format(len(trace), out_dir))
+        print(summary.to_string(float_format=lambda x: "{:.4g}".format(x)))
+
+# switched on by the environment: the process that set it reports at exit, worker processes only record
+if os.environ.get(ENV_VAR):
+    _out_dir = DEFAULT_DIR if os.environ[ENV_VAR] == "1" else os.environ[ENV_VAR]
+    if os.environ.get(ENV_VAR + "_OWNER") in (None, str(os.getpid())):
+        enable(_out_dir)
+    else:
+        _start(_out_dir)
@@ -0,0 +1,183 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import argparse
+from channels import CHANNELS, NEIGHBOUR_CHANNELS, stack_channel_windows, detect_channels_from_derivative, events_table
+from crossing import find_crossing_points
+from lysis_detection import stack_lysis_windows, savgol_derivative
+from experiment import cells, clean, fast_lysis_only, slow_only
+from trace_store import STORE_DIR, load_trace
+
+### Quality control of the events, in place of curating the inclusion lists of experiment.py (clean, fast_lysis_only and slow_only)
+### by inspection. A fixed set of features is computed for every event, all events at once on NaN padded 2D arrays (one row per
+### event, see stack_lysis_windows), and every feature is a handful of vectorized passes over two short windows of each trace:
+###  - the event window, the +/- 2 second window around the estimated lysis time on all four channels (see channels.py):
+###    peak_snr, the peak rate of intensity change of the cell above the baseline of the derivative (in standard deviations);
+###    cross_correlation, the largest absolute correlation of the derivative of the cell with that of the l or r region;
+###    plateau_length, the time for which the derivative of the cell stays within its baseline band (mean +/- n_std standard
+###    deviations, for window_length points) once it has settled back into it after the fall of the lysis rate, up to the end
+###    of the window;
+###    neighbour_intrusion, the flag of channels.py;
+###  - the baseline window, from baseline_start to baseline_end seconds before the estimated lysis time (before perforation) on
+###    the cell channel: baseline_noise, the standard deviation about a straight line fit (AU/px); baseline_drift, the change of
+###    the fitted line over the window in noise standard deviations; and baseline_stationarity, the scatter of the means of
+###    n_blocks consecutive blocks about the line, relative to the scatter expected of white noise (about 1 when stationary).
+### The rules (see RULES) give the allowed range of features for the fast lysis analysis and for the perforation analysis, and an
+### event is classed as clean (both), fast_lysis_only, slow_only or excluded, with the rules it failed as the reasons. The table
+### 'dataframes/qc_features.csv' is for review, and 'dataframes/qc_inclusion_lists.json' can replace the inclusion lists of
+### experiment.py (see qc_inclusion_lists there).
+
+# the allowed range ({"min": ..., "max": ...}) of each feature, for each analysis. NaN features fail their rules.
+RULES = {"lysis": {"peak_snr": {"min": 7},
+                   "cross_correlation": {"max": 0.5},
+                   "plateau_length": {"min": 0.5},
+                   "neighbour_intrusion": {"max": 0}},
+         "perforation": {"peak_snr": {"min": 5}, # the lysis start is still needed as the end of perforation
+                         "baseline_drift": {"min": -5, "max": 5},
+                         "baseline_stationarity": {"max": 3}}}
+
+FEATURES = ["peak_snr", "cross_correlation", "plateau_length", "neighbour_intrusion", "baseline_noise", "baseline_drift",
+            "baseline_stationarity"]
+
+def row_correlation(a, b):
+    """
+    return: the correlation coefficient of each pair of rows of the NaN padded 2D arrays a and b (over the points valid in both).
+    """
+    valid = ~(np.isnan(a) | np.isnan(b))
+    n = valid.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        a = np.where(valid, a - np.where(valid, a, 0).sum(axis=1, keepdims=True) / n[:, np.newaxis], 0)
+        b = np.where(valid, b - np.where(valid, b, 0).sum(axis=1, keepdims=True) / n[:, np.newaxis], 0)
+        return (a * b).sum(axis=1) / np.sqrt((a ** 2).sum(axis=1) * (b ** 2).sum(axis=1))
+
+def baseline_features(time_arr, value_arr, lengths, n_blocks=10):
+    """
+    Fits a straight line to each row of the NaN padded arrays (time_arr, value_arr) of the baseline windows.
+
+    return: baseline_noise, baseline_drift and baseline_stationarity (see the top of this file), one value per row.
+    """
+    valid = ~np.isnan(value_arr)
+    n = lengths.astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(valid, time_arr - np.where(valid, time_arr, 0).sum(axis=1, keepdims=True) / n[:, np.newaxis], 0)
+        v = np.where(valid, value_arr - np.where(valid, value_arr, 0).sum(axis=1, keepdims=True) / n[:, np.newaxis], 0)
+        slope = (t * v).sum(axis=1) / (t ** 2).sum(axis=1)
+        residual = np.where(valid, v - slope[:, np.newaxis] * t, 0)
+        noise = np.sqrt((residual ** 2).sum(axis=1) / (n - 2))
+        duration = np.nanmax(time_arr, axis=1, initial=-np.inf) - np.nanmin(time_arr, axis=1, initial=np.inf)
+        drift = slope * duration / noise
+
+        # the means of the residuals in n_blocks consecutive blocks of each row, summed with a single bincount
+        n_rows, n_cols = value_arr.shape
+        block = np.minimum(np.arange(n_cols)[np.newaxis, :] * n_blocks // np.maximum(lengths, 1)[:, np.newaxis], n_blocks - 1)
+        index = (np.arange(n_rows)[:, np.newaxis] * n_blocks + block)[valid]
+        block_sums = np.bincount(index, weights=residual[valid], minlength=n_rows * n_blocks).reshape(n_rows, n_blocks)
+        block_counts = np.bincount(index, minlength=n_rows * n_blocks).reshape(n_rows, n_blocks)
+        block_means = block_sums / block_counts
+        stationarity = np.nanstd(block_means, axis=1, ddof=1) / (noise / np.sqrt(n / n_blocks))
+    return noise, drift, stationarity
+
+def qc_features(traces, lysis_times, half_width=2, baseline_start=20, baseline_end=10, n_blocks=10, sg_window=8, sg_order=3, n_std=3,
+                window_length=5, min_score=8, coincidence=0.5, **threshold_params):
+    """
+    Computes the QC features (see the top of this file) of every event, for the traces ({cell: trace with "time" and the l, c, r
+    and st columns}) and estimated lysis times ({cell: time}). The event detection parameters are those of
+    '06_lysis_detection_all_data.py' (threshold_params are passed on to lysis_detection.detect_lysis_from_derivative), and
+    min_score and coincidence those of channels.py.
+
+    return: a table with one row per event (cell and the FEATURES columns), and the table of channels.channel_events.
+    """
+    cell_ids, time_arr, value_arr, lengths = stack_channel_windows(traces, lysis_times, half_width)
+    dsg = savgol_derivative(value_arr, lengths, sg_window, sg_order)
+    result = detect_channels_from_derivative(time_arr, dsg, lengths, n_std=n_std, window_length=window_length, **threshold_params)
+    events = events_table(cell_ids, result, min_score=min_score, coincidence=coincidence)
+
+    n_channels = len(CHANNELS)
+    c = CHANNELS.index("c")
+    rows = slice(c, None, n_channels)
+    dsg_c = dsg[rows]
+    features = pd.DataFrame({"cell": cell_ids})
+    features["peak_snr"] = events["c_score"]
+    features["cross_correlation"] = np.nanmax(np.abs([row_correlation(dsg_c, dsg[CHANNELS.index(ch)::n_channels])
+                                                      for ch in NEIGHBOUR_CHANNELS]), axis=0)
+
+    # the plateau after lysis starts once the derivative of the cell has settled back within its baseline band, and ends where it
+    # departs from it again (or at the end of the window)
+    mu = result["mu"][rows]
+    std = result["std"][rows]
+    fall_idx = result["fall_idx"][rows]
+    with np.errstate(invalid="ignore"):
+        departure = np.abs(dsg_c - mu[:, np.newaxis])
+    settle_idx = find_crossing_points(departure, n_std * std, window_length, start_idx=fall_idx, mode="decreasing")
+    end_idx = find_crossing_points(departure, n_std * std, window_length, start_idx=settle_idx, mode="increasing")
+    end_idx = np.where(end_idx >= 0, end_idx, lengths[rows] - 1)
+    time_c = time_arr[rows]
+    n_events = len(cell_ids)
+    plateau_length = time_c[np.arange(n_events), end_idx] - time_c[np.arange(n_events), np.clip(settle_idx, 0, None)]
+    features["plateau_length"] = np.where(fall_idx < 0, np.nan, np.where(settle_idx < 0, 0, plateau_length))
+    features["neighbour_intrusion"] = events["neighbour_intrusion"]
+
+    centres = {k: lysis_times[k] - (baseline_start + baseline_end) / 2 for k in cell_ids}
+    cell_ids, time_arr, value_arr, lengths = stack_lysis_windows(traces, centres, (baseline_start - baseline_end) / 2)
+    features["baseline_noise"], features["baseline_drift"], features["baseline_stationarity"] = baseline_features(time_arr, value_arr, lengths, n_blocks)
+    return features, events
+
+def apply_rules(features, rules=RULES):
+    """
+    Classes every event of the features table by the rules ({analysis: {feature: {"min": ..., "max": ...}}}).
+
+    return: a copy of features with lysis_ok, perforation_ok, inclusion (clean, fast_lysis_only, slow_only or excluded) and
+    reasons (the rules failed) columns.
+    """
+    features = features.copy()
+    reasons = [[] for _ in range(len(features))]
+    for analysis in ["lysis", "perforation"]:
+        ok = np.ones(len(features), dtype=bool)
+        for feature, limits in rules.get(analysis, {}).items():
+            values = features[feature].astype(float).to_numpy()
+            for bound, fails in [("min", lambda x, y: ~(x >= y)), ("max", lambda x, y: ~(x <= y))]:
+                if bound not in limits:
+                    continue
+                failed = fails(values, limits[bound])
+                ok &= ~failed
+                for i in np.flatnonzero(failed):
+                    reasons[i].append("{}: {} {} {}".format(analysis, feature, "<" if bound == "min" else ">", limits[bound]))
+        features[analysis + "_ok"] = ok
+    features["inclusion"] = np.select([features["lysis_ok"] & features["perforation_ok"], features["lysis_ok"], features["perforation_ok"]],
+                                      ["clean", "fast_lysis_only", "slow_only"], "excluded")
+    features["reasons"] = ["; ".join(r) for r in reasons]
+    return features
+
+def inclusion_lists(features):
+    """
+    return: the inclusion lists ({"clean": [...], "fast_lysis_only": [...], "slow_only": [...]}) of a table returned by apply_rules.
+    """
+    return {name: [int(k) for k in features["cell"][features["inclusion"] == name]] for name in ["clean", "fast_lysis_only", "slow_only"]}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute the QC features of every event and generate the inclusion lists.")
+    parser.add_argument("--rules", help="JSON file of rules, replacing the default RULES")
+    parser.add_argument("--out", default="dataframes/qc_features.csv", help="table of features and classes for review")
+    parser.add_argument("--lists", default="dataframes/qc_inclusion_lists.json", help="generated inclusion lists")
+    args = parser.parse_args()
+
+    rules = RULES
+    if args.rules:
+        with open(args.rules) as f:
+            rules = json.load(f)
+    lysis_times_adjusted = pd.read_csv("10ms_lysis_times_adjusted.csv")
+    lys_ts = dict(zip(lysis_times_adjusted["cell"], lysis_times_adjusted["lysis_t"]))
+    traces = {k: load_trace(k, columns=["time"] + CHANNELS, store_dir=STORE_DIR) for k in cells if k in lys_ts}
+    features, events = qc_features(traces, lys_ts)
+    features = apply_rules(features, rules)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    features.to_csv(args.out)
+    lists = inclusion_lists(features)
+    with open(args.lists, "w") as f:
+        json.dump(lists, f, indent=1)
+
+    curated = {"clean": clean, "fast_lysis_only": fast_lysis_only, "slow_only": slow_only}
+    for name, generated in lists.items():
+        print("{}: {} (not in the curated list: {}, missing: {})".format(name, generated, sorted(set(generated) - set(curated[name])),
+                                                                         sorted(set(curated[name]) - set(generated))))
@@ -0,0 +1,165 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+
+### A local results database (SQLite, 'results.sqlite') for the outputs of the lysis detection (06) and the perforation detection
+### (08), in place of overwriting the csv tables with every run. Every result is keyed by (experiment, trench, cell, param_hash),
+### where param_hash identifies the detection parameters (held in the params table), and records a hash of the source code of the
+### detection modules that produced it (code_version) and when it last changed. Results of different parameter sets are kept
+### side by side, and storing a run is an upsert that only writes the rows whose values changed.
+### The results are indexed by experiment and trench, so per-trench or per-experiment aggregates (trench_summary) are a single
+### indexed query, and the usual csv tables can be exported from any parameter set (export_results).
+
+RESULTS_DB = "results.sqlite"
+
+# the source files whose contents make up the code_version of a result
+CODE_FILES = ["lysis_detection.py", "perforation_detection.py", "crossing.py", "chunked.py", "collate.py", "timestamps.py"]
+
+# the csv tables of 06 and 08 that the results can be imported from and exported to
+EXPORTS = {"lysis": "dataframes/cell_envelope_breakdown_analysis.csv", "perforation": "dataframes/perforation_analysis.csv"}
+
+TABLES = {"lysis": ["rise_time", "peak_time", "fall_time"],
+          "perforation": ["start_time", "end_time", "perforation_duration", "baseline_offset"]}
+
+def param_hash(params):
+    """
+    return: a short hash of the parameters (a JSON serialisable dict).
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+def run_params(lysis_params, perforation_params, auto_baseline=False):
+    """
+    return: the parameters identifying the results of a run in each table ({"lysis": ..., "perforation": ...}), from the lysis
+    and perforation detection parameters. The perforation results depend on the lysis detection too (the end of perforation is
+    the lysis start), and on how the baseline windows were chosen.
+    """
+    return {"lysis": dict(lysis_params),
+            "perforation": {"lysis": dict(lysis_params), "perforation": dict(perforation_params),
+                            "baseline": "auto" if auto_baseline else "start_adjust"}}
+
+def code_version(files=CODE_FILES):
+    """
+    return: a short hash of the contents of the detection source files.
+    """
+    digest = hashlib.sha256()
+    for name in files:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+def connect(path=RESULTS_DB):
+    """
+    Opens the results database at path, creating the tables and indexes if needed.
+
+    return: the sqlite3 connection.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS params (param_hash TEXT PRIMARY KEY, params TEXT NOT NULL)")
+    for table, columns in TABLES.items():
+        conn.execute("CREATE TABLE IF NOT EXISTS {} (experiment TEXT NOT NULL, trench INTEGER NOT NULL, cell INTEGER NOT NULL, "
+                     "param_hash TEXT NOT NULL, {}, code_version TEXT, updated REAL, "
+                     "PRIMARY KEY (experiment, trench, cell, param_hash))".format(table, ", ".join(c + " REAL" for c in columns)))
+        conn.execute("CREATE INDEX IF NOT EXISTS {0}_by_params ON {0} (param_hash, experiment, trench)".format(table))
+    conn.commit()
+    return conn
+
+def upsert_results(conn, table, experiment, cells, results, params):
+    """
+    Stores the results of one run in table ("lysis" or "perforation"). results is a table with a cell column and the columns of
+    TABLES[table] (as written to the csv tables), cells maps each cell to its [trench, start_timepoint] (see experiment.py) and
+    params are the detection parameters of the run. Rows whose values and code_version are unchanged are left alone.
+
+    return: the number of rows inserted or updated.
+    """
+    columns = TABLES[table]
+    key = param_hash(params)
+    version = code_version()
+    conn.execute("INSERT OR IGNORE INTO params VALUES (?, ?)", (key, json.dumps(params, sort_keys=True)))
+    rows = []
+    for _, row in results.iterrows():
+        k = int(row["cell"])
+        values = [None if c not in row or pd.isna(row[c]) else float(row[c]) for c in columns]
+        rows.append([experiment, int(cells[k][0]), k, key] + values + [version, time.time()])
+    changed = " OR ".join("{0} IS NOT excluded.{0}".format(c) for c in columns + ["code_version"])
+    before = conn.total_changes
+    conn.executemany("INSERT INTO {0} VALUES ({1}) ON CONFLICT (experiment, trench, cell, param_hash) DO UPDATE SET {2} WHERE {3}".format(
+                         table, ", ".join("?" * (len(columns) + 6)),
+                         ", ".join("{0} = excluded.{0}".format(c) for c in columns + ["code_version", "updated"]), changed), rows)
+    conn.commit()
+    return conn.total_changes - before
+
+def export_results(conn, table, experiment, params):
+    """
+    return: the results of table ("lysis" or "perforation") for an experiment and parameter set (a dict, or its param_hash), in the
+    layout of the csv tables of 06 ('cell_envelope_breakdown_analysis.csv') and 08 ('perforation_analysis.csv').
+    """
+    key = params if isinstance(params, str) else param_hash(params)
+    columns = TABLES[table]
+    d = pd.read_sql_query("SELECT cell, {} FROM {} WHERE param_hash = ? AND experiment = ? ORDER BY cell".format(", ".join(columns), table),
+                          conn, params=(key, experiment))
+    if "baseline_offset" in d and d["baseline_offset"].isna().all():
+        d = d.drop(columns="baseline_offset")
+    elif "baseline_offset" in d:
+        d["baseline_offset"] = d["baseline_offset"].astype(int)
+    return d
+
+def trench_summary(conn, table, column, experiment=None, params=None):
+    """
+    Aggregates column of table ("lysis" or "perforation") per experiment and trench in one indexed query, optionally for a single
+    experiment and parameter set (a dict, or its param_hash).
+
+    return: a table (experiment, trench, param_hash, n, mean, std, min, max).
+    """
+    where = []
+    args = []
+    if params is not None:
+        where.append("param_hash = ?")
+        args.append(params if isinstance(params, str) else param_hash(params))
+    if experiment is not None:
+        where.append("experiment = ?")
+        args.append(experiment)
+    query = ("SELECT experiment, trench, param_hash, COUNT({0}) AS n, AVG({0}) AS mean, AVG({0} * {0}) AS mean_square, "
+             "MIN({0}) AS min, MAX({0}) AS max FROM {1} {2} GROUP BY param_hash, experiment, trench ORDER BY experiment, trench").format(
+                 column, table, "WHERE " + " AND ".join(where) if where else "")
+    d = pd.read_sql_query(query, conn, params=args)
+    # sample standard deviation from the mean and mean square
+    variance = (d["mean_square"] - d["mean"] ** 2) * d["n"] / (d["n"] - 1)
+    d.insert(5, "std", np.sqrt(variance.clip(lower=0)).where(d["n"] > 1))
+    return d.drop(columns="mean_square")
+
+if __name__ == "__main__":
+    from experiment import experiment_id, cells
+    from pipeline import LYSIS_PARAMS, PERFORATION_PARAMS
+
+    parser = argparse.ArgumentParser(description="Store the detection results in the results database, or export and summarise them.")
+    parser.add_argument("command", choices=["import", "export", "summary"],
+                        help="import the csv tables of 06 and 08, export them from the database, or print per-trench summaries")
+    parser.add_argument("--db", default=RESULTS_DB, help="results database (default {})".format(RESULTS_DB))
+    parser.add_argument("--params", help="JSON file of the detection parameters {\"lysis\": ..., \"perforation\": ...} (default those of 06 and 08)")
+    parser.add_argument("--auto-baseline", action="store_true", help="the perforation baseline windows were chosen automatically")
+    args = parser.parse_args()
+
+    lysis_params, perforation_params = LYSIS_PARAMS, PERFORATION_PARAMS
+    if args.params:
+        with open(args.params) as f:
+            given = json.load(f)
+        lysis_params = dict(LYSIS_PARAMS, **given.get("lysis", {}))
+        perforation_params = dict(PERFORATION_PARAMS, **given.get("perforation", {}))
+    params = run_params(lysis_params, perforation_params, args.auto_baseline)
+    conn = connect(args.db)
+    for table, path in EXPORTS.items():
+        if args.command == "import":
+            n = upsert_results(conn, table, experiment_id, cells, pd.read_csv(path, index_col=0, float_precision="round_trip"), params[table])
+            print("{}: {} rows changed ({})".format(table, n, param_hash(params[table])))
+        elif args.command == "export":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            export_results(conn, table, experiment_id, params[table]).to_csv(path)
+        else:
+            column = "rise_time" if table == "lysis" else "perforation_duration"
+            print("{} ({}):".format(table, column))
+            print(trench_summary(conn, table, column, experiment_id).to_string(index=False))
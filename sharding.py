@@ -0,0 +1,150 @@
+import pandas as pd
+import numpy as np
+import os
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import experiment
+from lysis_detection import stack_lysis_windows, detect_lysis_batch
+from perforation_detection import baseline_start_index, detect_perforation, find_baseline_window
+from pipeline import LYSIS_PARAMS, PERFORATION_PARAMS
+from trace_store import STORE_DIR, load_trace
+from trace_index import nearest_index
+
+### A sharded runner for the lysis and perforation detection of '06_lysis_detection_all_data.py' and
+### '08_perforation_detection_all_data.py', for experiments with many trenches and thousands of events.
+### The cells are split into shards by trench (the cells of a trench share a frame spacing), and large trenches are split further
+### into shards of at most shard_size cells. Each shard is processed by one worker of a process pool: its traces are loaded, the
+### lysis detection runs on the whole shard as one batch, and the perforation detection runs cell by cell. A failure of one cell
+### (a missing or unreadable trace, a missing lysis time, a detection error) is recorded and the shard carries on with the other
+### cells. The per-shard tables are merged and sorted by cell, so the output does not depend on the number of workers or the order
+### in which the shards finish.
+
+def shard_cells(cells, shard_size=50):
+    """
+    Splits cells ({cell_number: [trench_number, start_timepoint]}) into shards of cells from the same trench, of at most
+    shard_size cells each.
+
+    return: a list of shards (sorted lists of cell numbers), ordered by trench and then by cell.
+    """
+    trenches = {}
+    for k in sorted(cells):
+        trenches.setdefault(cells[k][0], []).append(k)
+    shards = []
+    for trench in sorted(trenches):
+        ks = trenches[trench]
+        shards.extend(ks[i:i + shard_size] for i in range(0, len(ks), shard_size))
+    return shards
+
+def _failure(cell, stage, error):
+    return {"cell": cell, "stage": stage, "error": "{}: {}".format(type(error).__name__, error),
+            "traceback": "".join(traceback.format_exception(type(error), error, error.__traceback__))}
+
+def _detect_lysis_isolated(traces, lys_ts, lysis_params, failures):
+    # detect lysis for all cells of the shard at once; if the batch fails, retry cell by cell to isolate the failing cells
+    batch_params = {name: value for name, value in lysis_params.items() if name != "half_width"}
+    try:
+        cell_ids, time_arr, value_arr, lengths = stack_lysis_windows(traces, lys_ts, half_width=lysis_params["half_width"])
+        fast_lysis = detect_lysis_batch(time_arr, value_arr, lengths, **batch_params)
+        return {k: {name: fast_lysis[name][i] for name in ["rise_time", "peak_time", "fall_time"]} for i, k in enumerate(cell_ids)}
+    except Exception:
+        if len(traces) == 1:
+            raise
+    results = {}
+    for k in traces:
+        try:
+            results.update(_detect_lysis_isolated({k: traces[k]}, {k: lys_ts[k]}, lysis_params, failures))
+        except Exception as e:
+            failures.append(_failure(k, "detect_lysis", e))
+    return results
+
+def _run_shard(args):
+    # process one shard: returns its lysis rows, perforation rows and failures
+    shard, lys_ts, lysis_cells, perforation_offsets, lysis_params, perforation_params, auto_baseline, store_dir = args
+    failures = []
+    traces = {}
+    for k in shard:
+        try:
+            if k not in lys_ts:
+                raise KeyError("no approximate lysis time for cell {}".format(k))
+            traces[k] = load_trace(k, columns=["timepoint", "time", "c"], store_dir=store_dir)
+        except Exception as e:
+            failures.append(_failure(k, "load", e))
+    lysis = _detect_lysis_isolated(traces, {k: lys_ts[k] for k in traces}, lysis_params, failures) if traces else {}
+
+    lysis_rows = [dict(cell=k, **lysis[k]) for k in shard if k in lysis and k in lysis_cells]
+    perforation_rows = []
+    for k in shard:
+        if k not in perforation_offsets or k not in lysis:
+            continue
+        try:
+            d = traces[k]
+            peak_idx = nearest_index(d["time"], lysis[k]["peak_time"])
+            if auto_baseline:
+                start_idx, offset, score, mu, std = find_baseline_window(d["c"], peak_idx, baseline_length=perforation_params["baseline_length"])
+            else:
+                offset = perforation_offsets[k]
+                start_idx = baseline_start_index(d["timepoint"], peak_idx, offset)
+            rise_idx, rise, mu, std = detect_perforation(d["time"], d["c"], start_idx, **perforation_params)
+            perforation_rows.append({"cell": k, "start_time": rise, "end_time": lysis[k]["rise_time"],
+                                     "perforation_duration": lysis[k]["rise_time"] - rise, "baseline_offset": offset})
+        except Exception as e:
+            failures.append(_failure(k, "detect_perforation", e))
+    return lysis_rows, perforation_rows, failures
+
+def run_sharded(cells=None, jobs=1, shard_size=50, lysis_params=None, perforation_params=None, auto_baseline=False,
+                lysis_times_path="10ms_lysis_times_adjusted.csv", store_dir=STORE_DIR, perforation=True):
+    """
+    Runs the lysis and perforation detection over cells (default experiment.cells), with the inclusion lists and baseline offsets
+    of experiment.py, on a pool of jobs worker processes, one shard (see shard_cells) at a time per worker. lysis_params and
+    perforation_params override entries of pipeline.LYSIS_PARAMS and pipeline.PERFORATION_PARAMS, and auto_baseline=True chooses
+    the perforation baseline windows with perforation_detection.find_baseline_window. perforation=False runs the lysis detection
+    only, for the cells included in the lysis analysis.
+
+    return: the cell envelope breakdown table (cell, rise_time, peak_time, fall_time), the perforation table (cell, start_time,
+    end_time, perforation_duration, baseline_offset) and a table of failures (cell, stage, error, traceback), each sorted by cell.
+    """
+    if cells is None:
+        cells = experiment.cells
+    lysis_params = dict(LYSIS_PARAMS, **(lysis_params or {}))
+    perforation_params = dict(PERFORATION_PARAMS, **(perforation_params or {}))
+    lysis_times_adjusted = pd.read_csv(lysis_times_path)
+    lys_ts = dict(zip(lysis_times_adjusted["cell"].tolist(), lysis_times_adjusted["lysis_t"].tolist()))
+
+    lysis_cells = set(experiment.clean + experiment.fast_lysis_only)
+    perforation_offsets = {k: experiment.baseline_offset + experiment.start_adjust.get(k, 0)
+                           for k in cells if k in experiment.clean + experiment.slow_only and perforation}
+    included = {k: v for k, v in cells.items() if k in lysis_cells or k in perforation_offsets}
+    tasks = [(shard, {k: lys_ts[k] for k in shard if k in lys_ts}, lysis_cells, perforation_offsets, lysis_params, perforation_params,
+              auto_baseline, store_dir) for shard in shard_cells(included, shard_size)]
+    if jobs <= 1:
+        results = [_run_shard(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_run_shard, tasks))
+
+    tables = []
+    for i, columns in enumerate([["cell", "rise_time", "peak_time", "fall_time"],
+                                 ["cell", "start_time", "end_time", "perforation_duration", "baseline_offset"],
+                                 ["cell", "stage", "error", "traceback"]]):
+        rows = [row for result in results for row in result[i]]
+        tables.append(pd.DataFrame(rows, columns=columns).sort_values("cell", kind="stable").reset_index(drop=True))
+    return tuple(tables)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the lysis and perforation detection over all cells, sharded by trench.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="number of worker processes (default: all cores)")
+    parser.add_argument("--shard-size", type=int, default=50, help="maximum number of cells per shard (default 50)")
+    parser.add_argument("--auto-baseline", action="store_true", help="choose the perforation baseline windows automatically")
+    args = parser.parse_args()
+
+    cell_envelope_breakdown_analysis, perforation_analysis, failures = run_sharded(jobs=args.jobs, shard_size=args.shard_size,
+                                                                                   auto_baseline=args.auto_baseline)
+    if not args.auto_baseline:
+        perforation_analysis = perforation_analysis.drop(columns="baseline_offset")
+    os.makedirs("dataframes", exist_ok=True)
+    cell_envelope_breakdown_analysis.to_csv("dataframes/cell_envelope_breakdown_analysis.csv")
+    perforation_analysis.to_csv("dataframes/perforation_analysis.csv")
+    failures.to_csv("dataframes/detection_failures.csv")
+    print("{} lysis events, {} perforation events, {} failures (see dataframes/detection_failures.csv)".format(
+        len(cell_envelope_breakdown_analysis), len(perforation_analysis), len(failures)))
@@ -0,0 +1,173 @@
+import numpy as np
+from collections import deque
+from scipy.signal import savgol_coeffs
+
+### Streaming lysis and perforation detection, for flagging events during acquisition rather than from finished csv files.
+### Frames (time, l, c, r, st) are consumed one at a time or in small chunks from any iterable (a generator, or a queue via
+### iter(queue.get, None)), and events are yielded as soon as the consecutive time point criteria of the offline method are met:
+###  - the Savitzky-Golay derivative is updated incrementally as a short FIR filter over the last sg_window frames, and agrees with
+###    savgol_filter away from the ends of the trace;
+###  - the lysis start (t5) is the first of lysis_window_length consecutive derivative values above the mean + n_std standard
+###    deviations of the derivative over a trailing baseline (by default 150 to 50 frames before, i.e. about 1.5 to 0.5 seconds at 10 ms,
+###    as in '06_lysis_detection_all_data.py', but measured back from the current frame rather than from the peak, which is not yet known);
+###  - the perforation start (t4) is the first of perforation_window_length consecutive intensities above the mean + n_std standard
+###    deviations of a 200 frame baseline ending perforation_lag frames earlier, as in '08_perforation_detection_all_data.py'.
+### Running statistics are updated in O(1) per frame, and only a bounded ring buffer of raw frames is kept, from which the frames
+### around each event are emitted once enough frames after it have arrived.
+
+class RunningStats:
+    """
+    Mean and standard deviation (ddof=1) of a sliding window of a fixed number of values, updated in O(1) per value.
+    The sums are taken relative to the first value seen, which avoids loss of precision when the values are large (e.g. ~300 AU/px)
+    compared with their spread.
+    """
+    def __init__(self, window_length):
+        self.window_length = window_length
+        self.values = deque()
+        self.shift = None
+        self.s1 = 0.0
+        self.s2 = 0.0
+
+    def push(self, value):
+        if self.shift is None:
+            self.shift = value
+        x = value - self.shift
+        self.values.append(x)
+        self.s1 += x
+        self.s2 += x * x
+        if len(self.values) > self.window_length:
+            old = self.values.popleft()
+            self.s1 -= old
+            self.s2 -= old * old
+
+    def full(self):
+        return len(self.values) == self.window_length
+
+    def mean(self):
+        return self.s1 / len(self.values) + self.shift
+
+    def std(self):
+        n = len(self.values)
+        return np.sqrt(max((self.s2 - self.s1 * self.s1 / n) / (n - 1), 0.0))
+
+def _iter_frames(frames):
+    # accept single frames (sequences of 5 values) or chunks (2D arrays with one frame per row)
+    for item in frames:
+        item = np.asarray(item, dtype=float)
+        if item.ndim == 1:
+            yield item
+        else:
+            for row in item:
+                yield row
+
+def stream_events(frames, sg_window=8, sg_order=3, n_std=3, lysis_window_length=5, lysis_baseline=(150, 50),
+                  perforation_window_length=5, perforation_baseline_length=200, perforation_lag=300,
+                  keep_before=3000, keep_after=500):
+    """
+    A generator that consumes frames (an iterable of (time, l, c, r, st) frames, or of 2D chunks of them) for one cell and yields
+    events as dicts as soon as they are detected:
+        {"event": "perforation", "index": i, "time": t, "threshold": ...}  - perforation start (t4)
+        {"event": "perforation_reset", "index": i, "time": t}             - the intensity fell back below the perforation threshold for
+                                                                            perforation_baseline_length frames before lysis, so the
+                                                                            previous perforation event was a false alarm
+        {"event": "lysis", "index": i, "time": t, "threshold": ...}        - lysis start (t5); detection stops after this event
+        {"event": "frames", "for": "perforation" or "lysis", "frames": array}  - the raw frames from keep_before frames before to
+                                                                            keep_after frames after an event (fewer if the stream ends)
+    Indices count frames from the start of the stream. Memory use is bounded by keep_before + keep_after frames (or keep_before +
+    sg_window // 2 + lysis_window_length frames, if keep_after is shorter than the delay of detection).
+    """
+    coeffs = savgol_coeffs(sg_window, sg_order, use="dot")
+    lead = sg_window // 2 # the filtered value at frame i needs frames up to i + lead (for sg_window = 8, frames i-3 to i+4)
+    recent_c = deque(maxlen=sg_window)
+    # events are found up to lag frames after they start (and their frames emitted a frame later), so raw has to reach back that far
+    lag = max(lead + lysis_window_length, perforation_window_length)
+    raw = deque(maxlen=keep_before + max(keep_after, lag) + 1)
+    raw_start = 0 # stream index of raw[0]
+    pending_snippets = [] # (event name, stream index of the event)
+
+    # lysis state: derivative values are delayed by lysis_baseline[1] frames before entering the baseline statistics
+    lysis_stats = RunningStats(lysis_baseline[0] - lysis_baseline[1])
+    dsg_delay = deque()
+    dsg_run = 0
+    prev_sg = None
+
+    # perforation state: intensities enter the baseline statistics perforation_lag frames late
+    perf_stats = RunningStats(perforation_baseline_length)
+    c_delay = deque()
+    perf_run = 0
+    below_run = 0
+    perforation_threshold = None # set while a perforation event is active, freezing the baseline
+
+    lysed = False
+    for i, frame in enumerate(_iter_frames(frames)):
+        t, c = frame[0], frame[2]
+        raw.append(frame)
+        if len(raw) == raw.maxlen:
+            raw_start = i - raw.maxlen + 1
+
+        # emit the frames around earlier events once enough frames have arrived after them
+        for name, idx in list(pending_snippets):
+            if i >= idx + keep_after:
+                yield {"event": "frames", "for": name, "frames": _snippet(raw, raw_start, idx, keep_before, keep_after)}
+                pending_snippets.remove((name, idx))
+        if lysed:
+            if not pending_snippets:
+                return
+            continue
+
+        # perforation: compare the intensity with the frozen or trailing baseline
+        if perforation_threshold is None:
+            c_delay.append(c)
+            if len(c_delay) > perforation_lag:
+                perf_stats.push(c_delay.popleft())
+            if perf_stats.full():
+                threshold = perf_stats.mean() + n_std * perf_stats.std()
+                perf_run = perf_run + 1 if c > threshold else 0
+                if perf_run == perforation_window_length:
+                    idx = i - perforation_window_length + 1
+                    perforation_threshold = threshold
+                    below_run = 0
+                    yield {"event": "perforation", "index": idx, "time": raw[idx - raw_start][0], "threshold": threshold}
+                    pending_snippets.append(("perforation", idx))
+        else:
+            below_run = below_run + 1 if c <= perforation_threshold else 0
+            if below_run == perforation_baseline_length:
+                perforation_threshold = None
+                perf_run = 0
+                c_delay.clear()
+                perf_stats = RunningStats(perforation_baseline_length) # the baseline restarts after the event
+                yield {"event": "perforation_reset", "index": i, "time": t}
+
+        # lysis: update the Savitzky-Golay derivative, which lags the newest frame by lead frames
+        recent_c.append(c)
+        if len(recent_c) < sg_window:
+            continue
+        sg = np.dot(coeffs, recent_c)
+        if prev_sg is None:
+            prev_sg = sg
+            continue
+        dsg = sg - prev_sg
+        prev_sg = sg
+        j = i - lead # the frame this derivative value belongs to
+
+        if lysis_stats.full():
+            threshold = lysis_stats.mean() + n_std * lysis_stats.std()
+            dsg_run = dsg_run + 1 if dsg > threshold else 0
+            if dsg_run == lysis_window_length:
+                idx = j - lysis_window_length + 1
+                lysed = True
+                yield {"event": "lysis", "index": idx, "time": raw[idx - raw_start][0], "threshold": threshold}
+                pending_snippets.append(("lysis", idx))
+                continue
+        dsg_delay.append(dsg)
+        if len(dsg_delay) > lysis_baseline[1]:
+            lysis_stats.push(dsg_delay.popleft())
+
+    # the stream has ended: emit whatever frames are available around outstanding events
+    for name, idx in pending_snippets:
+        yield {"event": "frames", "for": name, "frames": _snippet(raw, raw_start, idx, keep_before, keep_after)}
+
+def _snippet(raw, raw_start, idx, keep_before, keep_after):
+    lo = max(idx - keep_before - raw_start, 0)
+    hi = idx + keep_after + 1 - raw_start
+    return np.asarray(list(raw))[lo:hi]
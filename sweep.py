@@ -0,0 +1,154 @@
+import pandas as pd
+import numpy as np
+import os
+import itertools
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import experiment
+from cache import CACHE_DIR
+from lysis_detection import stack_lysis_windows, savgol_derivative, cached_savgol_derivative, detect_lysis_from_derivative
+from perforation_detection import baseline_start_index, detect_perforation
+from trace_store import STORE_DIR, load_trace
+from trace_index import nearest_index
+
+### A parameter sweep over the detection parameters of '06_lysis_detection_all_data.py' and '08_perforation_detection_all_data.py',
+### for sensitivity analyses. A grid of parameter values is expanded into every combination, and the lysis start (t5) and
+### perforation start (t4) of every included cell are found for each combination. The grid is split by filter parameters
+### (sg_window, sg_order): the Savitzky-Golay derivative of all cells is computed once per filter setting, as one batch, and then
+### reused for every combination of the remaining (threshold) parameters, so changing only a threshold never refilters. The
+### derivative of each filter setting is kept in the derivative cache (see cache.py), so later sweeps over the same windows do not
+### refilter either. The
+### perforation detection depends on the lysis detection only through the peak, so its result is reused for every parameter set
+### that gives a cell the same peak and perforation parameters.
+### The parameter sets of each filter setting are split into chunks, so that a sweep over the thresholds of a single filter setting
+### still spreads over the whole pool of worker processes; every chunk is handed the derivative of its filter setting.
+### The result is a tidy table with one row per (parameter set, cell).
+
+FILTER_PARAMS = ["sg_window", "sg_order"]
+
+# the parameters used in the paper; a grid lists the values to try for any of them
+DEFAULT_PARAMS = {"sg_window": 8, # Savitzky-Golay window size
+                  "sg_order": 3, # Savitzky-Golay polynomial order
+                  "n_std": 3, # lysis threshold, in standard deviations above the mean derivative
+                  "window_length": 5, # consecutive time points above the lysis threshold
+                  "start_offset": 60, # the lysis rise search starts this many time points before the peak
+                  "baseline_start": 1.5, # the derivative baseline runs from baseline_start to baseline_end seconds before the peak
+                  "baseline_end": 0.5,
+                  "perforation_n_std": 3, # perforation threshold, in standard deviations above the mean intensity
+                  "perforation_window_length": 5, # consecutive time points above the perforation threshold
+                  "perforation_baseline_length": 200} # length of the perforation baseline window in time points
+
+def expand_grid(grid):
+    """
+    Expands grid ({parameter: list of values}, for any of the parameters in DEFAULT_PARAMS) into every combination of values.
+    Parameters missing from the grid take their DEFAULT_PARAMS value.
+
+    return: a list of parameter dicts.
+    """
+    unknown = set(grid) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError("unknown sweep parameters: {}".format(", ".join(sorted(unknown))))
+    names = list(DEFAULT_PARAMS)
+    values = [list(grid.get(name, [DEFAULT_PARAMS[name]])) for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+def _sweep_filter_group(args):
+    # evaluate a chunk of parameter sets sharing one filter setting, from the derivative dsg of that setting
+    dsg, param_sets, cell_ids, time_arr, lengths, perforation_offsets, store_dir = args
+    traces = {}
+    perforation = {} # (cell, peak_idx, perforation parameters): start_time
+    rows = []
+    for params in param_sets:
+        fast_lysis = detect_lysis_from_derivative(time_arr, dsg, lengths, n_std=params["n_std"], window_length=params["window_length"],
+                                                  start_offset=params["start_offset"], baseline_start=params["baseline_start"],
+                                                  baseline_end=params["baseline_end"])
+        for i, k in enumerate(cell_ids):
+            start_time = np.nan
+            peak_time = fast_lysis["peak_time"][i]
+            if k in perforation_offsets and not np.isnan(peak_time):
+                if k not in traces:
+                    traces[k] = load_trace(k, columns=["timepoint", "time", "c"], store_dir=store_dir)
+                d = traces[k]
+                peak_idx = nearest_index(d["time"], peak_time)
+                key = (k, peak_idx, params["perforation_baseline_length"], params["perforation_n_std"], params["perforation_window_length"])
+                if key not in perforation:
+                    start_idx = baseline_start_index(d["timepoint"], peak_idx, perforation_offsets[k])
+                    rise_idx, perforation[key], mu, std = detect_perforation(d["time"], d["c"], start_idx,
+                                                                             baseline_length=params["perforation_baseline_length"],
+                                                                             n_std=params["perforation_n_std"],
+                                                                             window_length=params["perforation_window_length"])
+                start_time = perforation[key]
+            row = dict(params)
+            row.update({"cell": k,
+                        "rise_time": fast_lysis["rise_time"][i],
+                        "peak_time": peak_time,
+                        "fall_time": fast_lysis["fall_time"][i],
+                        "start_time": start_time,
+                        "perforation_duration": fast_lysis["rise_time"][i] - start_time})
+            rows.append(row)
+    return rows
+
+def run_sweep(grid, jobs=1, lysis_times_path="10ms_lysis_times_adjusted.csv", store_dir=STORE_DIR, cache_dir=CACHE_DIR):
+    """
+    Runs the lysis and perforation detection for every parameter set in the expanded grid, over the cells included in either
+    analysis (experiment.clean, fast_lysis_only and slow_only). The perforation baseline offsets are those of experiment.py.
+    With jobs > 1 the parameter sets are distributed over a pool of jobs worker processes, in chunks of the same filter setting.
+    The derivative of each filter setting is read from or added to the derivative cache in cache_dir (None to always filter).
+
+    return: a tidy table with the parameter values, cell, rise_time (t5), peak_time, fall_time, start_time (t4, NaN for cells not
+    included in the perforation analysis) and perforation_duration for every (parameter set, cell).
+    """
+    param_sets = expand_grid(grid)
+    lysis_times_adjusted = pd.read_csv(lysis_times_path)
+    lysis_cells = [k for k in experiment.cells if k in experiment.clean + experiment.fast_lysis_only + experiment.slow_only]
+    perforation_offsets = {k: experiment.baseline_offset + experiment.start_adjust.get(k, 0)
+                           for k in lysis_cells if k in experiment.clean + experiment.slow_only}
+
+    traces = {k: load_trace(k, columns=["time", "c"], store_dir=store_dir) for k in lysis_cells}
+    lys_ts = {k: lysis_times_adjusted["lysis_t"][lysis_times_adjusted["cell"] == k].tolist()[0] for k in lysis_cells}
+    cell_ids, time_arr, value_arr, lengths = stack_lysis_windows(traces, lys_ts, half_width=2)
+
+    groups = {}
+    for params in param_sets:
+        groups.setdefault(tuple(params[name] for name in FILTER_PARAMS), []).append(params)
+    # enough chunks per filter setting to give every worker a share of the sweep
+    n_chunks = max(1, -(-jobs // len(groups)))
+    tasks = []
+    for (sg_window, sg_order), sets in groups.items():
+        if cache_dir is None:
+            dsg = savgol_derivative(value_arr, lengths, sg_window, sg_order)
+        else:
+            dsg = np.asarray(cached_savgol_derivative(value_arr, lengths, sg_window, sg_order, cache_dir)[0])
+        size = -(-len(sets) // n_chunks)
+        tasks.extend((dsg, sets[i:i + size], cell_ids, time_arr, lengths, perforation_offsets, store_dir) for i in range(0, len(sets), size))
+    if jobs <= 1:
+        results = [_sweep_filter_group(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_sweep_filter_group, tasks))
+    return pd.DataFrame([row for rows in results for row in rows])
+
+def parse_values(text):
+    # "3,4,5" -> [3, 4, 5], keeping integers as integers
+    values = []
+    for item in text.split(","):
+        value = float(item)
+        values.append(int(value) if value.is_integer() and "." not in item else value)
+    return values
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep the lysis and perforation detection parameters.")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=V1,V2,...",
+                        help="values to try for a parameter, e.g. --set n_std=2,3,4 (repeatable; see sweep.DEFAULT_PARAMS)")
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes (default 1)")
+    parser.add_argument("--out", default="dataframes/parameter_sweep.csv", help="output table")
+    parser.add_argument("--no-cache", action="store_true", help="filter every setting again instead of using the derivative cache")
+    args = parser.parse_args()
+
+    grid = {}
+    for item in args.set:
+        name, values = item.split("=", 1)
+        grid[name] = parse_values(values)
+    sweep = run_sweep(grid, jobs=args.jobs, cache_dir=None if args.no_cache else CACHE_DIR)
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    sweep.to_csv(args.out)
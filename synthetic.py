@@ -0,0 +1,95 @@
+import pandas as pd
+import numpy as np
+import os
+import argparse
+from chunked import CHUNK_SIZE, chunk_bounds
+from collate import REGIONS, region_path
+from trace_store import STORE_DIR, create_trace
+
+### Synthetic lysis events with known perforation and lysis start times, for benchmarking and checking the analysis without the
+### lab data. Each cell trace is a flat phase contrast intensity with Gaussian noise; at the perforation start (t4) the intensity
+### of the cell jumps up by perforation_jump and then ramps up by perforation_ramp until the lysis start (t5), where the full
+### envelope breakdown adds a further step of lysis_step approached exponentially (lysis_tau frames). The regions either side of
+### the cell and the side trench are flat with noise. The events are placed in the second half of each trace, with a perforation
+### duration of 200 to 600 time points, which keeps the perforation baseline window of '08_perforation_detection_all_data.py'
+### (from 1000 time points before the peak) before t4.
+### The traces are written straight to the trace store ('lysis_data_time_adjusted'), a chunk at a time so that traces of millions
+### of time points never have to fit in memory, together with the approximate lysis time tables and the ground truth
+### ('ground_truth.csv'). The Fiji region files ('lys_NN_region.csv') can be written as well, as input for '01_time_adjust_data.py'.
+
+def event_profile(idx, t4_idx, t5_idx, perforation_jump=8, perforation_ramp=10, perforation_tau=3, lysis_step=80, lysis_tau=15):
+    """
+    return: the noise free change in cell intensity (AU/px) at the time point indices idx (an array), for an event with
+    perforation starting at index t4_idx and lysis at index t5_idx.
+    """
+    idx = np.asarray(idx, dtype=float)
+    since_t4 = np.clip(idx - t4_idx, 0, t5_idx - t4_idx)
+    profile = np.where(idx >= t4_idx, perforation_jump * (1 - np.exp(-since_t4 / perforation_tau)) + perforation_ramp * since_t4 / (t5_idx - t4_idx), 0)
+    return profile + lysis_step * (1 - np.exp(-np.clip(idx - t5_idx, 0, None) / lysis_tau))
+
+def generate_experiment(out_dir, n_cells=4, n_frames=10000, n_trenches=1, frame_spacing=0.0102, noise=1.5, baseline=330, seed=0,
+                        write_regions=False, chunk_size=CHUNK_SIZE, **event_params):
+    """
+    Writes n_cells synthetic traces of n_frames time points to the trace store in out_dir, spread over n_trenches trenches with
+    frame spacing frame_spacing (seconds), along with '10ms_lysis_times.csv', '10ms_lysis_times_adjusted.csv' (approximate lysis
+    times within +/- 20 time points of t5) and 'ground_truth.csv'. With write_regions=True the Fiji region files are written too.
+    event_params are passed on to event_profile.
+
+    return: the ground truth table (cell, trench, t4_idx, t5_idx, t4, t5), and the cells dict ({cell: [trench, 0]}) and frame
+    spacing list describing the experiment, as in experiment.py.
+    """
+    if n_frames < 4000:
+        raise ValueError("synthetic traces need at least 4000 time points, got {}".format(n_frames))
+    rng = np.random.default_rng(seed)
+    store_dir = os.path.join(out_dir, STORE_DIR)
+    os.makedirs(store_dir, exist_ok=True)
+    cells = {k: [(k - 1) % n_trenches + 1, 0] for k in range(1, n_cells + 1)}
+    spacings = [frame_spacing] * n_trenches
+
+    truth = []
+    lysis_times = []
+    for k, (trench, start) in cells.items():
+        t5_idx = int(rng.integers(max(n_frames // 2, 2500), n_frames - 1000))
+        t4_idx = t5_idx - int(rng.integers(200, 600))
+        noise_rng = np.random.default_rng([seed, k])
+        columns = create_trace(k, trench, n_frames, store_dir)
+        regions = {region: open(region_path(k, region, out_dir), "w") for region in REGIONS} if write_regions else {}
+        for lo, hi, core_lo, core_hi in chunk_bounds(n_frames, chunk_size):
+            idx = np.arange(lo, hi)
+            chunk = {"timepoint": idx, "time": (idx + start) * frame_spacing}
+            chunk["l"] = baseline + noise_rng.normal(0, noise, hi - lo)
+            chunk["c"] = baseline + noise_rng.normal(0, noise, hi - lo) + event_profile(idx, t4_idx, t5_idx, **event_params)
+            chunk["r"] = baseline + noise_rng.normal(0, noise, hi - lo)
+            chunk["st"] = baseline - 30 + noise_rng.normal(0, noise, hi - lo)
+            for name in columns:
+                columns[name][lo:hi] = chunk[name]
+            for region, f in regions.items():
+                d = pd.DataFrame({"Slice": idx + 1, "Mean": chunk[region]}, index=idx)
+                d.to_csv(f, header=(lo == 0))
+        for arr in columns.values():
+            arr.flush()
+        for f in regions.values():
+            f.close()
+        truth.append({"cell": k, "trench": trench, "t4_idx": t4_idx, "t5_idx": t5_idx,
+                      "t4": (t4_idx + start) * frame_spacing, "t5": (t5_idx + start) * frame_spacing})
+        lysis_times.append({"cell": k, "lysis_t_start": start + t5_idx + int(rng.integers(-20, 21))})
+
+    truth = pd.DataFrame(truth)
+    truth.to_csv(os.path.join(out_dir, "ground_truth.csv"), index=False)
+    lysis_times = pd.DataFrame(lysis_times)
+    lysis_times.to_csv(os.path.join(out_dir, "10ms_lysis_times.csv"), index=False)
+    lysis_times["lysis_t"] = lysis_times["lysis_t_start"] * frame_spacing
+    lysis_times.to_csv(os.path.join(out_dir, "10ms_lysis_times_adjusted.csv"))
+    return truth, cells, spacings
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic experiment with known perforation and lysis times.")
+    parser.add_argument("out_dir", help="directory to write the experiment to")
+    parser.add_argument("--cells", type=int, default=4, help="number of cells (default 4)")
+    parser.add_argument("--frames", type=int, default=10000, help="time points per trace (default 10000)")
+    parser.add_argument("--trenches", type=int, default=1, help="number of trenches (default 1)")
+    parser.add_argument("--noise", type=float, default=1.5, help="standard deviation of the intensity noise in AU/px (default 1.5)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+    parser.add_argument("--regions", action="store_true", help="also write the Fiji region files")
+    args = parser.parse_args()
+    generate_experiment(args.out_dir, args.cells, args.frames, args.trenches, noise=args.noise, seed=args.seed, write_regions=args.regions)
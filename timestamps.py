@@ -0,0 +1,73 @@
+import numpy as np
+import os
+import re
+import json
+import hashlib
+
+### Per-frame timestamps from the image metadata .txt files, for a time axis built from the recorded acquisition times rather than
+### a mean frame spacing per trench (the spacing varies by 1.3 to 2.0% around the nominal 10 ms).
+### The metadata file is read as one block of bytes and every timestamp is picked out with a single compiled regular expression,
+### and the matches are converted to numbers in one call, so no Python loop runs over the lines or frames. The timestamps are
+### cached as a .npy file next to the other derived data (keyed by the path, size and modification time of the metadata file and
+### the parsing options), and later loads memory-map the cached array instead of parsing the text again.
+
+CACHE_DIR = ".timestamps"
+
+# one capture group holding the timestamp of a frame; frames are assumed to appear in acquisition order.
+# the default matches the per-frame "ElapsedTime-ms" entries written by Micro-Manager. Patterns starting with a literal
+# (rather than an optional character) are scanned much faster.
+TIMESTAMP_PATTERN = r'ElapsedTime-ms"?\s*[:=]\s*"?([-+0-9.eE]+)'
+TIMESTAMP_SCALE = 1e-3 # seconds per timestamp unit
+
+def parse_timestamps(path, pattern=TIMESTAMP_PATTERN, scale=TIMESTAMP_SCALE):
+    """
+    Reads every timestamp (the first group of each match of pattern) from the metadata file at path.
+
+    return: a 1D float64 array of the timestamps in seconds, one per frame, in file order.
+    """
+    with open(path, "rb") as f:
+        text = f.read()
+    matches = re.findall(pattern.encode(), text)
+    if not matches:
+        raise ValueError("no timestamps matching {} in {}".format(pattern, path))
+    timestamps = np.array(b" ".join(matches).split(), dtype=np.float64)
+    return timestamps * scale
+
+def cache_path(path, pattern=TIMESTAMP_PATTERN, scale=TIMESTAMP_SCALE, cache_dir=CACHE_DIR):
+    """
+    return: the path of the cached timestamps of the metadata file at path, which changes whenever the file or the parsing
+    options change.
+    """
+    stat = os.stat(path)
+    key = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns, pattern, scale])
+    return os.path.join(cache_dir, "{}.npy".format(hashlib.sha256(key.encode()).hexdigest()[:16]))
+
+def load_timestamps(path, pattern=TIMESTAMP_PATTERN, scale=TIMESTAMP_SCALE, cache_dir=CACHE_DIR):
+    """
+    Loads the per-frame timestamps of the metadata file at path, from the cache if it is up to date, and otherwise parses the
+    file (parse_timestamps) and caches the result.
+
+    return: a read-only memory-mapped 1D array of the timestamps in seconds.
+    """
+    cached = cache_path(path, pattern, scale, cache_dir)
+    if not os.path.exists(cached):
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cached + ".tmp.npy", parse_timestamps(path, pattern, scale))
+        os.replace(cached + ".tmp.npy", cached)
+    return np.load(cached, mmap_mode="r")
+
+def frame_times(timepoints, frame_spacing, metadata_path=None):
+    """
+    Converts timepoints (frame numbers from the start of the acquisition of a trench) to times in seconds from the first frame.
+    If metadata_path is given, the recorded timestamps of the frames are used (see load_timestamps), otherwise the timepoints
+    are multiplied by the mean frame_spacing of the trench. timepoints may be a scalar or an array.
+
+    return: the time (or array of times) in seconds.
+    """
+    if metadata_path is None:
+        return np.asarray(timepoints) * frame_spacing
+    timestamps = load_timestamps(metadata_path)
+    timepoints = np.asarray(timepoints, dtype=np.int64)
+    if np.any(timepoints < 0) or np.any(timepoints >= len(timestamps)):
+        raise ValueError("timepoints outside the {} frames recorded in {}".format(len(timestamps), metadata_path))
+    return timestamps[timepoints] - timestamps[0]
@@ -0,0 +1,72 @@
+import numpy as np
+
+### Index lookups on the time axis of a trace.
+### The time column is monotonically increasing ((timepoint + start_timepoint) * frame_spacing), and the timepoint column counts
+### consecutive frames, so positions can be found with a binary search or direct arithmetic instead of scanning the full column
+### with a boolean mask or an exact float comparison (which breaks if a time has been round-tripped through a CSV file inexactly).
+### Windows are returned as slices of the underlying arrays, which for memory-mapped traces means no data is copied or read
+### outside the window.
+
+def time_to_index(time_arr, t, side="left"):
+    """
+    Finds the position of time t in the sorted time_arr with a binary search. With side="left" (default) this is the index
+    of the first time >= t, with side="right" the index of the first time > t. t may be a scalar or an array.
+
+    return: the index (or array of indices), between 0 and len(time_arr).
+    """
+    return np.searchsorted(time_arr, t, side=side)
+
+def nearest_index(time_arr, t, atol=1e-6):
+    """
+    Finds the index of the time in the sorted time_arr closest to t, for looking up times that were stored elsewhere
+    (e.g. the peak_time column of 'cell_envelope_breakdown_analysis.csv') and may have picked up rounding errors.
+    Raises a ValueError if the closest time differs from t by more than atol seconds.
+
+    return: the index of the closest time.
+    """
+    idx = int(np.searchsorted(time_arr, t, side="left"))
+    if idx == len(time_arr) or (idx > 0 and abs(time_arr[idx - 1] - t) <= abs(time_arr[idx] - t)):
+        idx = idx - 1
+    if idx < 0 or abs(time_arr[idx] - t) > atol:
+        raise ValueError("no time point within {} s of {}".format(atol, t))
+    return idx
+
+def index_to_time(time_arr, idx):
+    """
+    return: the time at index idx (a scalar or an array of indices).
+    """
+    return np.asarray(time_arr)[idx]
+
+def timepoint_to_index(timepoint_arr, timepoint):
+    """
+    Finds the index of a timepoint (frame number). If the timepoints are consecutive, as written by '01_time_adjust_data.py'
+    and kept by '03_trim_oversized_data.py', this is direct arithmetic; otherwise a binary search is used.
+    Raises a ValueError if the timepoint is not present.
+
+    return: the index of timepoint.
+    """
+    first = int(timepoint_arr[0])
+    n = len(timepoint_arr)
+    if int(timepoint_arr[n - 1]) - first == n - 1:
+        idx = int(timepoint) - first
+    else:
+        idx = int(np.searchsorted(timepoint_arr, timepoint, side="left"))
+    if idx < 0 or idx >= n or timepoint_arr[idx] != timepoint:
+        raise ValueError("timepoint {} is not in the trace".format(timepoint))
+    return idx
+
+def time_window_slice(time_arr, t_start, t_end):
+    """
+    return: the slice of rows with t_start <= time < t_end.
+    """
+    return slice(int(np.searchsorted(time_arr, t_start, side="left")), int(np.searchsorted(time_arr, t_end, side="left")))
+
+def time_window(trace, t_start, t_end):
+    """
+    Selects the rows of a trace (a dict {column: array} as returned by trace_store.load_trace) with t_start <= time < t_end.
+    This is equivalent to d[(d["time"] >= t_start) & (d["time"] < t_end)], but costs O(log n) and returns views rather than copies.
+
+    return: a dict {column: array} holding the window.
+    """
+    rows = time_window_slice(trace["time"], t_start, t_end)
+    return {name: arr[rows] for name, arr in trace.items()}
@@ -0,0 +1,180 @@
+import numpy as np
+import os
+import json
+from trace_index import time_window_slice
+from profiling import profiled, add_bytes_read
+
+### Columnar binary storage for the time adjusted lysis data.
+### Each cell is stored as a directory 'lysis_data_time_adjusted/lysis_NN/' holding one typed .npy file per column
+### (timepoint, time, l, c, r and st) and a small 'meta.json' with the cell and trench numbers. The .npy files are
+### memory-mapped when read, so a script that only needs a window around the lysis event only touches those rows on disk,
+### and nothing has to be reparsed from text. The per-cell 'lysis_NN.csv' layout written by earlier versions of
+### '01_time_adjust_data.py' can still be exported (export_csv), and is read as a fallback if no binary copy exists.
+### A cell can be restricted to a time range (a view, see set_view) without rewriting its data: the range is recorded in 'meta.json'
+### and applied by load_trace, which then returns memory-mapped views of just those rows.
+### pandas is only imported for the legacy CSV layout, so that reading the binary store does not pay for importing it.
+
+STORE_DIR = "lysis_data_time_adjusted"
+
+# column name: dtype on disk
+COLUMNS = {"timepoint": np.int64,
+           "time": np.float64,
+           "l": np.float64,
+           "c": np.float64,
+           "r": np.float64,
+           "st": np.float64}
+
+def trace_path(cell, store_dir=STORE_DIR):
+    """
+    return: the directory holding the binary columns for cell.
+    """
+    return os.path.join(store_dir, "lysis_{}".format(str(cell).zfill(2)))
+
+def csv_path(cell, store_dir=STORE_DIR):
+    """
+    return: the path of the legacy per-cell CSV file for cell.
+    """
+    return os.path.join(store_dir, "lysis_{}.csv".format(str(cell).zfill(2)))
+
+@profiled("save_trace", cell_arg="cell")
+def save_trace(cell, trench, columns, store_dir=STORE_DIR):
+    """
+    Saves the time series of one cell. columns is a dict (or table) containing every column in COLUMNS; each column is
+    written as its own .npy file with the dtype given in COLUMNS. Any existing copy of the cell is overwritten.
+    """
+    path = trace_path(cell, store_dir)
+    os.makedirs(path, exist_ok=True)
+    n = None
+    for name, dtype in COLUMNS.items():
+        arr = np.ascontiguousarray(np.asarray(columns[name]), dtype=dtype)
+        if n is not None and len(arr) != n:
+            raise ValueError("column {} of cell {} has {} rows, expected {}".format(name, cell, len(arr), n))
+        n = len(arr)
+        np.save(os.path.join(path, name + ".npy"), arr)
+    # a view set on an earlier copy of the cell is kept (it is a time range, so it still applies to the new data)
+    meta = {"cell": int(cell), "trench": int(trench), "n_rows": int(n)}
+    if os.path.exists(os.path.join(path, "meta.json")):
+        view = load_trace_info(cell, store_dir).get("view")
+        if view is not None:
+            meta["view"] = view
+    _write_meta(path, meta)
+
+def create_trace(cell, trench, n_rows, store_dir=STORE_DIR):
+    """
+    Creates the stored columns of one cell with n_rows rows, for writers that produce a trace a chunk at a time (e.g. traces too
+    long to hold in memory). Any existing copy of the cell is overwritten.
+
+    return: a dict {column: writable memory-mapped array}; the data is on disk once the arrays are flushed or deleted.
+    """
+    path = trace_path(cell, store_dir)
+    os.makedirs(path, exist_ok=True)
+    columns = {name: np.lib.format.open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=dtype, shape=(int(n_rows),))
+               for name, dtype in COLUMNS.items()}
+    _write_meta(path, {"cell": int(cell), "trench": int(trench), "n_rows": int(n_rows)})
+    return columns
+
+def _write_meta(path, meta):
+    with open(os.path.join(path, "meta.json.tmp"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(path, "meta.json.tmp"), os.path.join(path, "meta.json"))
+
+def set_view(cell, t_start, t_end, store_dir=STORE_DIR):
+    """
+    Restricts a stored cell to the rows with t_start <= time < t_end (in seconds) without rewriting its data; load_trace then
+    returns only those rows unless full=True. Replaces any earlier view of the cell.
+    """
+    path = trace_path(cell, store_dir)
+    if not os.path.isdir(path):
+        raise ValueError("cell {} has no binary copy in {}, so no view can be set".format(cell, store_dir))
+    meta = load_trace_info(cell, store_dir)
+    meta["view"] = [float(t_start), float(t_end)]
+    _write_meta(path, meta)
+
+def clear_view(cell, store_dir=STORE_DIR):
+    """
+    Removes the view of a stored cell, if any, so that load_trace returns every row again.
+    """
+    meta = load_trace_info(cell, store_dir)
+    if meta.pop("view", None) is not None:
+        _write_meta(trace_path(cell, store_dir), meta)
+
+def load_trace_info(cell, store_dir=STORE_DIR):
+    """
+    return: the metadata dict of a stored cell, {"cell": ..., "trench": ..., "n_rows": ...}, with also "view": [t_start, t_end]
+    if a view is set. n_rows counts every stored row.
+    """
+    path = trace_path(cell, store_dir)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f)
+    import pandas as pd
+    d = pd.read_csv(csv_path(cell, store_dir), usecols=["cell", "trench"])
+    return {"cell": int(d["cell"].iloc[0]), "trench": int(d["trench"].iloc[0]), "n_rows": len(d)}
+
+@profiled("load_trace", cell_arg="cell")
+def load_trace(cell, columns=None, rows=None, store_dir=STORE_DIR, mmap=True, full=False):
+    """
+    Loads the time series of one cell as a dict {column: array}. columns selects a subset of COLUMNS (default all of them)
+    and rows is an optional slice (or (start, stop) pair) of rows to return. With mmap=True (default) the arrays are read-only
+    memory-mapped views of the .npy files, so only the requested rows are ever read from disk; use mmap=False to load copies
+    into memory. If the cell has a view (see set_view), only its rows are returned, and rows counts from the start of the view;
+    full=True ignores the view. If the cell has no binary copy, the legacy CSV file is read instead.
+
+    return: a dict of 1D arrays, one per requested column.
+    """
+    if columns is None:
+        columns = list(COLUMNS)
+    if rows is None:
+        rows = slice(None)
+    elif not isinstance(rows, slice):
+        rows = slice(*rows)
+
+    path = trace_path(cell, store_dir)
+    if not os.path.isdir(path):
+        import pandas as pd
+        d = pd.read_csv(csv_path(cell, store_dir), usecols=columns)
+        return {name: np.asarray(d[name], dtype=COLUMNS[name])[rows] for name in columns}
+
+    view = None if full else load_trace_info(cell, store_dir).get("view")
+    if view is not None:
+        view_rows = time_window_slice(np.load(os.path.join(path, "time.npy"), mmap_mode="r"), view[0], view[1])
+        selected = range(view_rows.start, view_rows.stop)[rows]
+        rows = slice(selected.start, selected.stop, selected.step)
+
+    trace = {}
+    for name in columns:
+        arr = np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None)
+        trace[name] = arr[rows]
+        if mmap:
+            add_bytes_read(trace[name].nbytes) # the rows that may be read through the memory map
+    return trace
+
+def list_cells(store_dir=STORE_DIR):
+    """
+    return: a sorted list of the cell numbers present in the store, in binary or CSV form.
+    """
+    cells = set()
+    for name in os.listdir(store_dir):
+        stem = name[:-4] if name.endswith(".csv") else name
+        if stem.startswith("lysis_") and stem[6:].isdigit():
+            cells.add(int(stem[6:]))
+    return sorted(cells)
+
+def export_csv(cell, path=None, store_dir=STORE_DIR):
+    """
+    Writes the time series of one cell in the legacy CSV layout (columns timepoint, time, cell, trench, l, c, r, st,
+    preceded by the pandas index), by default to 'lysis_data_time_adjusted/lysis_NN.csv'.
+    """
+    import pandas as pd
+    if path is None:
+        path = csv_path(cell, store_dir)
+    info = load_trace_info(cell, store_dir)
+    trace = load_trace(cell, store_dir=store_dir)
+    d = pd.DataFrame()
+    d["timepoint"] = trace["timepoint"]
+    d["time"] = trace["time"]
+    d["cell"] = info["cell"]
+    d["trench"] = info["trench"]
+    for name in ["l", "c", "r", "st"]:
+        d[name] = trace[name]
+    d.to_csv(path)
@@ -0,0 +1,115 @@
+import numpy as np
+from scipy.signal import savgol_filter
+from crossing import find_crossing_points
+from lysis_detection import detect_lysis_batch
+from trace_index import time_window_slice
+
+### Monte Carlo confidence intervals for the lysis start (t5) and perforation start (t4).
+### For each cell, replicates of the trace are generated by a residual block bootstrap: the trace is split into a smooth component
+### (a wide Savitzky-Golay filter) and residual noise, and each replicate is the smooth component plus residuals resampled in
+### blocks of consecutive points (which keeps the short range correlation of the noise). A single replicate segment covers both the
+### perforation baseline window and the +/- 2 second lysis window, and the whole detection chain (Savitzky-Golay derivative -> peak
+### -> baseline statistics -> threshold crossings, then the perforation baseline placed relative to each replicate's own peak) is
+### run on all replicates of a cell at once as one 2D batch. The percentiles of the replicate estimates give the intervals.
+
+def bootstrap_replicates(values, n_replicates=1000, block_length=10, smooth_window=31, smooth_order=3, rng=None):
+    """
+    Generates n_replicates residual block bootstrap replicates of the 1D array values.
+    The smooth component is savgol_filter(values, smooth_window, smooth_order), and the residuals are resampled in blocks of
+    block_length consecutive points chosen uniformly at random.
+
+    return: a 2D array of shape (n_replicates, len(values)).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    smooth = savgol_filter(values, smooth_window, smooth_order)
+    residual = values - smooth
+    n_blocks = -(-n // block_length)
+    starts = rng.integers(0, n - block_length + 1, size=(n_replicates, n_blocks))
+    idx = (starts[:, :, np.newaxis] + np.arange(block_length)).reshape(n_replicates, -1)[:, :n]
+    return smooth + residual[idx]
+
+def replicate_event_times(trace, lys_t, perforation_offset=None, n_replicates=1000, half_width=2, lysis_params=None,
+                          perforation_baseline_length=200, perforation_n_std=3, perforation_window_length=5, block_length=10, rng=None):
+    """
+    Runs the lysis detection (and, if perforation_offset is given, the perforation detection with its baseline window starting
+    perforation_offset time points before each replicate's peak) on n_replicates bootstrap replicates of one cell.
+    trace is a dict {column: array} with consecutive time points (as returned by trace_store.load_trace), and lys_t the estimated lysis
+    time. lysis_params are passed on to lysis_detection.detect_lysis_batch.
+
+    return: a dict of 1D arrays with one value per replicate: rise_time (t5), peak_time and, if perforation_offset is given,
+    start_time (t4) and perforation_duration (t5 - t4). Replicates where an event was not found are NaN.
+    """
+    time = np.asarray(trace["time"], dtype=float)
+    window = time_window_slice(time, lys_t - half_width, lys_t + half_width)
+    lo = window.start if perforation_offset is None else max(0, window.start - perforation_offset)
+    hi = window.stop
+    seg_time = time[lo:hi]
+    replicates = bootstrap_replicates(np.asarray(trace["c"][lo:hi], dtype=float), n_replicates, block_length=block_length, rng=rng)
+
+    # lysis detection on the window part of every replicate
+    w0 = window.start - lo
+    n_window = hi - window.start
+    time_arr = np.broadcast_to(seg_time[w0:], (n_replicates, n_window))
+    lengths = np.full(n_replicates, n_window)
+    fast_lysis = detect_lysis_batch(time_arr, replicates[:, w0:], lengths, **(lysis_params or {}))
+    result = {"rise_time": fast_lysis["rise_time"], "peak_time": fast_lysis["peak_time"]}
+    if perforation_offset is None:
+        return result
+
+    # perforation detection, with each replicate's baseline window placed relative to its own peak
+    has_peak = fast_lysis["peak_idx"] >= 0
+    start_idx = np.where(has_peak, w0 + fast_lysis["peak_idx"] - perforation_offset, 0)
+    valid = has_peak & (start_idx >= 0)
+    start_idx = np.clip(start_idx, 0, None)
+    centred = replicates - np.mean(replicates[:, :perforation_baseline_length])
+    s1 = np.zeros((n_replicates, replicates.shape[1] + 1))
+    s2 = np.zeros((n_replicates, replicates.shape[1] + 1))
+    np.cumsum(centred, axis=1, out=s1[:, 1:])
+    np.cumsum(centred * centred, axis=1, out=s2[:, 1:])
+    rows = np.arange(n_replicates)
+    stop = np.minimum(start_idx + perforation_baseline_length, replicates.shape[1])
+    n = stop - start_idx
+    sum1 = s1[rows, stop] - s1[rows, start_idx]
+    sum2 = s2[rows, stop] - s2[rows, start_idx]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mu = sum1 / n
+        std = np.sqrt(np.clip((sum2 - sum1 * mu) / (n - 1), 0, None))
+    rise_idx = find_crossing_points(centred, mu + perforation_n_std * std, perforation_window_length, start_idx=start_idx, mode="increasing")
+    found = valid & (rise_idx >= 0)
+    result["start_time"] = np.where(found, seg_time[np.clip(rise_idx, 0, None)], np.nan)
+    result["perforation_duration"] = result["rise_time"] - result["start_time"]
+    return result
+
+def confidence_interval(samples, level=0.95):
+    """
+    return: the lower and upper percentile bounds of the central level interval of samples, ignoring NaN (NaN if all are NaN).
+    """
+    samples = np.asarray(samples, dtype=float)
+    if np.all(np.isnan(samples)):
+        return np.nan, np.nan
+    tail = (1 - level) / 2 * 100
+    return tuple(np.nanpercentile(samples, [tail, 100 - tail]))
+
+def event_time_intervals(traces, lys_ts, perforation_offsets=None, n_replicates=1000, level=0.95, seed=0, **kwargs):
+    """
+    Finds confidence intervals of the lysis start (t5) for every cell in traces ({cell: trace}, with estimated lysis times lys_ts
+    {cell: lys_t}), and of the perforation start (t4) for the cells in perforation_offsets ({cell: baseline offset in time points}).
+    Other keyword arguments are passed on to replicate_event_times. The replicates are drawn from one generator seeded with seed,
+    so the intervals are reproducible.
+
+    return: a dict {cell: {"rise_time_lower", "rise_time_upper"}}, with also "start_time_lower", "start_time_upper",
+    "perforation_duration_lower" and "perforation_duration_upper" for the cells in perforation_offsets.
+    """
+    rng = np.random.default_rng(seed)
+    perforation_offsets = perforation_offsets or {}
+    intervals = {}
+    for k in sorted(traces):
+        samples = replicate_event_times(traces[k], lys_ts[k], perforation_offsets.get(k), n_replicates=n_replicates, rng=rng, **kwargs)
+        intervals[k] = {}
+        for name in ["rise_time", "start_time", "perforation_duration"]:
+            if name in samples:
+                intervals[k][name + "_lower"], intervals[k][name + "_upper"] = confidence_interval(samples[name], level)
+    return intervals